@@ -1,12 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Query
+from fastapi.responses import StreamingResponse
 from typing import List, Optional 
 from pydantic import BaseModel, Field
-from datetime import datetime
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timezone
+import json
+import re
 
 from models.user import User, UserUpdate
-from core.database import user_collection, user_helper
+from core.config import ADMIN_PAGE_MAX_SIZE, ADMIN_BULK_MAX_ITEMS
+from core.database import user_collection, user_helper, partial_user_helper, USER_FIELDS
+from core.user_cache import evict_user, evict_users
 from core.security import generate_access_key, get_admin_user
 from core.config_manager import get_system_config, update_system_config, SystemConfig
+from services.analysis_pipeline import pipeline_stats
+from services.resilience import upstream_health
+from services.analytics import (
+    GRANULARITIES, DEFAULT_RANGES, MAX_RANGES, bucket_start, rollup_helper, get_rollups, get_top_rollups,
+)
+from services.events import event_hub
 
 class SystemConfigUpdate(BaseModel):
     api_enabled: Optional[bool] = None
@@ -14,12 +27,74 @@ class SystemConfigUpdate(BaseModel):
     daily_lockdown_end_utc: Optional[str] = None
 
     maintenance_message: Optional[str] = None
+
+    rate_limit_per_minute: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
+    max_concurrent_per_user: Optional[int] = None
+    max_concurrent_global: Optional[int] = None
+    admission_queue_size: Optional[int] = None
+    admission_queue_timeout_seconds: Optional[float] = None
     
 class NotificationRequest(BaseModel):
     message: str
 
+class BulkNotificationRequest(BaseModel):
+    user_ids: List[str]
+    message: str
+
+class BulkUserUpdate(UserUpdate):
+    id: str
+
 router = APIRouter()
 
+def _parse_fields(fields: Optional[str]) -> tuple:
+    if not fields:
+        return USER_FIELDS
+    requested = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = set(requested) - set(USER_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+def _user_filter(is_active: Optional[bool], username_prefix: Optional[str], after: Optional[str] = None) -> dict:
+    query = {}
+    if is_active is not None:
+        query["is_active"] = is_active
+    if username_prefix:
+        # Anchored prefix regex, so the username index is used.
+        query["username"] = {"$regex": f"^{re.escape(username_prefix)}"}
+    if after:
+        query["_id"] = {"$gt": after}
+    return query
+
+def _check_bulk_size(count: int):
+    if count == 0:
+        raise HTTPException(status_code=400, detail="No items provided.")
+    if count > ADMIN_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {ADMIN_BULK_MAX_ITEMS} items per bulk request.")
+
+def _check_granularity(granularity: str):
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Rollup buckets are naive UTC, like every other timestamp stored by the backend.
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value and value.tzinfo else value
+
+def _analytics_range(granularity: str, start: Optional[datetime], end: Optional[datetime]) -> tuple:
+    _check_granularity(granularity)
+    start, end = _naive_utc(start), _naive_utc(end)
+    end = end or datetime.utcnow()
+    start = start or end - DEFAULT_RANGES[granularity]
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end.")
+    if end - start > MAX_RANGES[granularity]:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_RANGES[granularity].days} days of {granularity} buckets per request.")
+    return bucket_start(start, granularity), end
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
 @router.get("/admin/users", response_model=List[dict], dependencies=[Depends(get_admin_user)])
 async def get_all_users():
     """Get a list of all users for the admin panel."""
@@ -37,6 +112,113 @@ async def create_user(user_data: User = Body(...)):
     created_user = await user_collection.find_one({"_id": new_user.inserted_id})
     return user_helper(created_user)
 
+@router.get("/admin/users/page", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def get_users_page(
+    limit: int = Query(100, ge=1, le=ADMIN_PAGE_MAX_SIZE),
+    after: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    username_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Cursor-paginated user listing. Pass the returned next_cursor as `after` to get the
+    following page; `fields` is a comma-separated list limiting what is returned.
+    """
+    selected = _parse_fields(fields)
+    cursor = user_collection.find(
+        _user_filter(is_active, username_prefix, after),
+        {field: 1 for field in selected}
+    ).sort("_id", 1).limit(limit + 1)
+    users = await cursor.to_list(length=limit + 1)
+    next_cursor = str(users[limit - 1]["_id"]) if len(users) > limit else None
+    return {"items": [partial_user_helper(user, selected) for user in users[:limit]], "next_cursor": next_cursor}
+
+@router.get("/admin/users/export", dependencies=[Depends(get_admin_user)])
+async def export_users(
+    is_active: Optional[bool] = None,
+    username_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """Streams every matching user as newline-delimited JSON without holding the list in memory."""
+    selected = _parse_fields(fields)
+    cursor = user_collection.find(
+        _user_filter(is_active, username_prefix),
+        {field: 1 for field in selected},
+        batch_size=1000
+    ).sort("_id", 1)
+
+    async def lines():
+        async for user in cursor:
+            yield json.dumps(partial_user_helper(user, selected), default=_json_default) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.post("/admin/users/bulk", response_model=dict, status_code=status.HTTP_201_CREATED, dependencies=[Depends(get_admin_user)])
+async def create_users_bulk(users_data: List[User] = Body(...)):
+    """Create many users with a single unordered bulk write."""
+    _check_bulk_size(len(users_data))
+    user_dicts = []
+    for user_data in users_data:
+        user_data.access_key = generate_access_key()
+        user_dicts.append(user_data.model_dump(by_alias=True))
+    failed = {}
+    try:
+        await user_collection.bulk_write([InsertOne(user_dict) for user_dict in user_dicts], ordered=False)
+    except BulkWriteError as e:
+        failed = {error["index"]: error.get("errmsg") for error in e.details.get("writeErrors", [])}
+    return {
+        "created": [user_helper(user_dict) for index, user_dict in enumerate(user_dicts) if index not in failed],
+        "errors": [{"index": index, "detail": detail} for index, detail in sorted(failed.items())],
+    }
+
+@router.patch("/admin/users/bulk", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def update_users_bulk(updates: List[BulkUserUpdate] = Body(...)):
+    """
+    Update many users with a single unordered bulk write. Items that fail are reported
+    by their index in `errors`; the others are still applied.
+    """
+    _check_bulk_size(len(updates))
+    operations = []
+    indexes = []
+    errors = {}
+    for index, update_data in enumerate(updates):
+        update_dict = {k: v for k, v in update_data.model_dump(by_alias=True, exclude={"id"}).items() if v is not None}
+        if update_dict:
+            operations.append(UpdateOne({"_id": update_data.id}, {"$set": update_dict}))
+            indexes.append(index)
+        else:
+            errors[index] = "No update data provided."
+    if not operations:
+        raise HTTPException(status_code=400, detail="No update data provided.")
+    try:
+        result = await user_collection.bulk_write(operations, ordered=False)
+        matched, modified = result.matched_count, result.modified_count
+    except BulkWriteError as e:
+        matched, modified = e.details.get("nMatched", 0), e.details.get("nModified", 0)
+        errors.update({indexes[error["index"]]: error.get("errmsg") for error in e.details.get("writeErrors", [])})
+    user_ids = [updates[index].id for index in indexes if index not in errors]
+    evict_users(user_ids)
+    for user_id in user_ids:
+        event_hub.notify_user(user_id)
+    return {
+        "matched": matched,
+        "modified": modified,
+        "errors": [{"index": index, "detail": detail} for index, detail in sorted(errors.items())],
+    }
+
+@router.post("/admin/users/bulk/notify", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(get_admin_user)])
+async def send_notification_to_users(request: BulkNotificationRequest = Body(...)):
+    """Queues the same notification for many users with one update."""
+    _check_bulk_size(len(request.user_ids))
+    update_result = await user_collection.update_many(
+        {"_id": {"$in": request.user_ids}},
+        {"$set": {"pending_notification": request.message}}
+    )
+    evict_users(request.user_ids)
+    for user_id in request.user_ids:
+        event_hub.notify_user(user_id)
+    return {"detail": f"Notification queued for {update_result.matched_count} users."}
+
 @router.put("/admin/users/{user_id}", response_model=dict, dependencies=[Depends(get_admin_user)])
 async def update_user(user_id: str, update_data: UserUpdate = Body(...)):
     """Update a user's details."""
@@ -44,6 +226,8 @@ async def update_user(user_id: str, update_data: UserUpdate = Body(...)):
     if not update_dict:
         raise HTTPException(status_code=400, detail="No update data provided.")
     await user_collection.update_one({"_id": user_id}, {"$set": update_dict})
+    evict_user(user_id=user_id)
+    event_hub.notify_user(user_id)
     updated_user = await user_collection.find_one({"_id": user_id})
     if updated_user:
         return user_helper(updated_user)
@@ -53,6 +237,8 @@ async def update_user(user_id: str, update_data: UserUpdate = Body(...)):
 async def delete_user(user_id: str):
     """Delete a user."""
     delete_result = await user_collection.delete_one({"_id": user_id})
+    evict_user(user_id=user_id)
+    event_hub.notify_user(user_id)
     if delete_result.deleted_count == 0:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found.")
     return
@@ -61,6 +247,8 @@ async def delete_user(user_id: str):
 async def send_notification_to_user(user_id: str, request: NotificationRequest = Body(...)):
     """Sets a pending notification message for a specific user."""
     update_result = await user_collection.update_one({"_id": user_id}, {"$set": {"pending_notification": request.message}})
+    evict_user(user_id=user_id)
+    event_hub.notify_user(user_id)
     if update_result.matched_count == 0:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found.")
     return {"detail": "Notification queued for user."}
@@ -69,6 +257,8 @@ async def send_notification_to_user(user_id: str, request: NotificationRequest =
 async def trigger_remote_uninstall(user_id: str):
     """Flags a user's application for remote uninstallation on next launch."""
     update_result = await user_collection.update_one({"_id": user_id}, {"$set": {"uninstall_pending": True}})
+    evict_user(user_id=user_id)
+    event_hub.notify_user(user_id)
     if update_result.matched_count == 0:
         raise HTTPException(status_code=404, detail=f"User with id {user_id} not found.")
     return {"detail": "Application has been flagged for uninstallation."}
@@ -76,7 +266,7 @@ async def trigger_remote_uninstall(user_id: str):
 @router.get("/admin/system-config", response_model=SystemConfig, dependencies=[Depends(get_admin_user)])
 async def get_current_system_config():
     """Retrieves the current global system configuration."""
-    return await get_system_config()
+    return await get_system_config(fresh=True)
 
 @router.put("/admin/system-config", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(get_admin_user)])
 async def update_current_system_config(config_update: SystemConfigUpdate = Body(...)):
@@ -85,4 +275,68 @@ async def update_current_system_config(config_update: SystemConfigUpdate = Body(
     if not update_data:
         raise HTTPException(status_code=400, detail="No configuration data provided.")
     await update_system_config(update_data)
-    return {"detail": "System configuration updated successfully."}
\ No newline at end of file
+    event_hub.notify_all()
+    return {"detail": "System configuration updated successfully."}
+
+@router.get("/admin/pipeline-stats", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def get_pipeline_stats():
+    """Compares latency and token cost of the two-stage and fused pipelines since this worker started."""
+    return pipeline_stats.snapshot()
+
+@router.get("/admin/upstream-health", response_model=List[dict], dependencies=[Depends(get_admin_user)])
+async def get_upstream_health():
+    """Circuit breaker state and average latency of every provider endpoint this worker has called."""
+    return upstream_health()
+
+@router.get("/admin/analytics/users", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def get_top_users_usage(
+    granularity: str = "day",
+    bucket: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=ADMIN_PAGE_MAX_SIZE),
+):
+    """The busiest users in one hour or day (the current one by default), from the usage rollups."""
+    _check_granularity(granularity)
+    bucket = bucket_start(_naive_utc(bucket) or datetime.utcnow(), granularity)
+    rollups = await get_top_rollups("user", granularity, bucket, limit)
+    usernames = {
+        user["_id"]: user.get("username")
+        async for user in user_collection.find({"_id": {"$in": [rollup["key"] for rollup in rollups]}}, {"username": 1})
+    }
+    return {
+        "granularity": granularity,
+        "bucket": bucket,
+        "items": [{"user_id": rollup["key"], "username": usernames.get(rollup["key"]), **rollup_helper(rollup)} for rollup in rollups],
+    }
+
+@router.get("/admin/analytics/users/{user_id}", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def get_user_usage(
+    user_id: str,
+    granularity: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """Calls, outcomes and latency of one user per hour or day, read from the usage rollups."""
+    start, end = _analytics_range(granularity, start, end)
+    rollups = await get_rollups("user", granularity, start, end, key=user_id)
+    return {"user_id": user_id, "granularity": granularity, "buckets": [rollup_helper(rollup) for rollup in rollups]}
+
+@router.get("/admin/analytics/models", response_model=dict, dependencies=[Depends(get_admin_user)])
+async def get_model_usage(
+    granularity: str = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Provider requests and their error rate per model over the range, with the per-bucket
+    breakdown. Every endpoint attempt counts, including retries, fallbacks and hedges.
+    """
+    start, end = _analytics_range(granularity, start, end)
+    models = {}
+    for rollup in await get_rollups("model", granularity, start, end):
+        model = models.setdefault(rollup["key"], {"model_id": rollup["key"], "calls": 0, "errors": 0, "buckets": []})
+        model["calls"] += rollup.get("calls", 0)
+        model["errors"] += rollup.get("errors", 0)
+        model["buckets"].append(rollup_helper(rollup))
+    for model in models.values():
+        model["error_rate"] = round(model["errors"] / model["calls"], 4) if model["calls"] else 0.0
+    return {"granularity": granularity, "start": start, "end": end, "models": sorted(models.values(), key=lambda model: -model["calls"])}
\ No newline at end of file
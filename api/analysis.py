@@ -1,21 +1,39 @@
-from fastapi import APIRouter, Body, HTTPException, status, Request, Depends
+from fastapi import APIRouter, Body, HTTPException, status, Request, Depends, Header
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from datetime import datetime
+from typing import List
+import asyncio
 import secrets
 import json
 
-from .dependencies import check_api_status
+from .dependencies import check_api_status, admission_control, Admission
+from core.config import MAX_IMAGE_BYTES, BATCH_MAX_IMAGES, BATCH_MAX_PARALLELISM
 from core.database import user_collection
-from services.llm_service import get_image_description_from_ixl, get_final_answer_from_txl
+from core.log import get_logger
+from core.metrics import ANALYZE_STAGE_DURATION, ANALYZE_IN_FLIGHT, start_request_timings
+from core.user_cache import get_user_by_access_key, get_user_for_device, update_cached_user, evict_user
+from services.analysis_pipeline import analyze_image, stream_analysis, decode_image_data, InvalidImageError
+from services.analytics import usage_analytics
+from services.usage import usage_tracker
 from models.user import LLMConfig
 
 router = APIRouter()
+logger = get_logger("analysis")
+
+UPSTREAM_ERROR_DETAIL = "I'm stuck in a glitch... The external AI service may be down. Please try again in a moment."
 
 class AnalysisRequest(BaseModel):
     access_key: str
     device_key: str
     image_data: str
 
+class BatchAnalysisRequest(BaseModel):
+    access_key: str
+    device_key: str
+    images: List[str]
+
 class SecureRequest(BaseModel):
     access_key: str
     device_key: str
@@ -26,44 +44,243 @@ class ActivationRequest(BaseModel):
 @router.post("/auth/activate")
 async def activate_device(payload: ActivationRequest):
     access_key = payload.access_key
-    user = await user_collection.find_one({"access_key": access_key})
+    user = await get_user_by_access_key(access_key)
     if not user or not user.get("is_active"):
         raise HTTPException(status_code=403, detail="Invalid or inactive access key.")
     new_device_key = f"bkm_dev_{secrets.token_urlsafe(32)}"
     await user_collection.update_one({"_id": user["_id"]}, {"$set": {"device_key": new_device_key}})
-    print(f"Generated and saved new device key for user {user.get('username', 'unknown')}.")
+    evict_user(access_key=access_key)
+    logger.info("Generated and saved new device key", extra={"username": user.get("username", "unknown")})
     return {"device_key": new_device_key}
 
-@router.post("/analyze", dependencies=[Depends(check_api_status)])
-async def analyze_screen(request: AnalysisRequest):
-    user = await user_collection.find_one({"access_key": request.access_key})
-    if not user or not user.get("is_active") or user.get("device_key") != request.device_key:
+async def _authorize_analysis(access_key: str, device_key: str, admission: Admission, cost: int = 1, parallelism: int = 1) -> dict:
+    """Verifies the credentials, then charges the user's rate limit and concurrency slots."""
+    with ANALYZE_STAGE_DURATION.time(stage="user_lookup"):
+        user = await get_user_for_device(access_key, device_key)
+    if not user or not user.get("is_active"):
         raise HTTPException(status_code=403, detail="Invalid credentials or device key mismatch.")
-    
+
     if user.get("expires_on") and user["expires_on"] < datetime.utcnow():
         raise HTTPException(status_code=403, detail="Your Access Key has expired.")
-        
-    if user.get("api_call_limit") is not None and user.get("api_calls_total", 0) >= user["api_call_limit"]:
+    await admission.admit(user, cost, parallelism)
+    return user
+
+async def _run_analysis(user: dict, image_bytes: bytes, endpoint: str) -> dict:
+    if not usage_tracker.reserve(user):
+        usage_analytics.record(user, endpoint, "quota_exceeded")
         raise HTTPException(status_code=429, detail="API call limit reached for this key.")
 
     try:
         try:
             ixl_config = LLMConfig(**user.get("ixl_config", {}))
             txl_config = LLMConfig(**user.get("txl_config", {}))
-            image_description = await get_image_description_from_ixl(request.image_data, ixl_config)
-            final_answer = await get_final_answer_from_txl(image_description, txl_config)
+            with ANALYZE_IN_FLIGHT.track_in_progress(), ANALYZE_STAGE_DURATION.time(stage="pipeline"):
+                final_answer = await analyze_image(image_bytes, ixl_config, txl_config, user.get("pipeline_mode", "two_stage"))
         except Exception as llm_error:
-            print(f"External LLM API Error: {llm_error}")
-            raise HTTPException(status_code=503, detail="I'm stuck in a glitch... The external AI service may be down. Please try again in a moment.")
+            logger.warning("External LLM API error", extra={"user_id": user["_id"], "error": str(llm_error)})
+            usage_analytics.record(user, endpoint, "upstream_error")
+            raise HTTPException(status_code=503, detail=UPSTREAM_ERROR_DETAIL)
 
-        await user_collection.update_one({"_id": user["_id"]}, {"$inc": {"api_calls_total": 1}})
+        usage_tracker.commit(user)
+        usage_analytics.record(user, endpoint, "ok")
         return {"result": final_answer}
     except HTTPException as http_exc:
+        usage_tracker.refund(user)
         raise http_exc
     except Exception as e:
-        print(f"Unexpected internal server error during analysis: {e}")
+        usage_tracker.refund(user)
+        usage_analytics.record(user, endpoint, "error")
+        logger.exception("Unexpected internal server error during analysis", extra={"user_id": user["_id"]})
         raise HTTPException(status_code=500, detail="An unexpected internal server error occurred.")
 
+async def _read_image_body(request: Request) -> bytes:
+    """Reads a raw image body chunk by chunk, rejecting it as soon as it exceeds MAX_IMAGE_BYTES."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large.")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail="Image is too large.")
+        chunks.append(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Request body is empty.")
+    return b"".join(chunks)
+
+@router.post("/analyze", dependencies=[Depends(check_api_status)])
+async def analyze_screen(request: AnalysisRequest, admission: Admission = Depends(admission_control)):
+    start_request_timings()
+    user = await _authorize_analysis(request.access_key, request.device_key, admission)
+    try:
+        image_bytes = decode_image_data(request.image_data)
+    except InvalidImageError as image_error:
+        usage_analytics.record(user, "analyze", "invalid_image")
+        raise HTTPException(status_code=400, detail=str(image_error))
+    return await _run_analysis(user, image_bytes, "analyze")
+
+@router.post("/analyze/raw", dependencies=[Depends(check_api_status)])
+async def analyze_screen_raw(
+    request: Request,
+    x_access_key: str = Header(...),
+    x_device_key: str = Header(...),
+    admission: Admission = Depends(admission_control),
+):
+    """
+    Same as /analyze, but the body is the raw image (application/octet-stream) and the
+    credentials travel in the X-Access-Key / X-Device-Key headers. Avoids the base64
+    inflation and the extra copies of parsing the image out of a JSON body.
+    """
+    start_request_timings()
+    user = await _authorize_analysis(x_access_key, x_device_key, admission)
+    image_bytes = await _read_image_body(request)
+    return await _run_analysis(user, image_bytes, "analyze_raw")
+
+@router.post("/analyze/batch", dependencies=[Depends(check_api_status)])
+async def analyze_screen_batch(request: BatchAnalysisRequest, admission: Admission = Depends(admission_control)):
+    """
+    Analyzes up to BATCH_MAX_IMAGES captures in one call. Credentials are checked and
+    quota for every image is reserved once; the images then run concurrently, at most
+    BATCH_MAX_PARALLELISM at a time and never more than the concurrency slots free. Each item gets its own `status` and either a `result`
+    or a `detail`, so one bad image does not fail the rest. Only successful items are
+    counted against the quota.
+    """
+    count = len(request.images)
+    if not count:
+        raise HTTPException(status_code=400, detail="No images provided.")
+    if count > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_IMAGES} images per batch.")
+
+    start_request_timings()
+    user = await _authorize_analysis(request.access_key, request.device_key, admission, cost=count, parallelism=min(count, BATCH_MAX_PARALLELISM))
+    if not usage_tracker.reserve(user, count):
+        for _ in range(count):
+            usage_analytics.record(user, "analyze_batch", "quota_exceeded")
+        raise HTTPException(status_code=429, detail="API call limit reached for this key.")
+
+    ixl_config = LLMConfig(**user.get("ixl_config", {}))
+    txl_config = LLMConfig(**user.get("txl_config", {}))
+    pipeline_mode = user.get("pipeline_mode", "two_stage")
+    # One pipeline per concurrency slot the batch was admitted with.
+    parallelism = asyncio.Semaphore(admission.parallelism)
+
+    async def run_item(index: int, image_data: str) -> dict:
+        # Each item runs in its own task, so it gets its own latency and stage timings.
+        start_request_timings()
+        try:
+            image_bytes = decode_image_data(image_data)
+        except InvalidImageError as image_error:
+            usage_analytics.record(user, "analyze_batch", "invalid_image")
+            return {"index": index, "status": 400, "detail": str(image_error)}
+        async with parallelism:
+            try:
+                with ANALYZE_IN_FLIGHT.track_in_progress(), ANALYZE_STAGE_DURATION.time(stage="pipeline"):
+                    final_answer = await analyze_image(image_bytes, ixl_config, txl_config, pipeline_mode)
+            except Exception as llm_error:
+                logger.warning("External LLM API error", extra={"user_id": user["_id"], "index": index, "error": str(llm_error)})
+                usage_analytics.record(user, "analyze_batch", "upstream_error")
+                return {"index": index, "status": 503, "detail": UPSTREAM_ERROR_DETAIL}
+        usage_analytics.record(user, "analyze_batch", "ok")
+        return {"index": index, "status": 200, "result": final_answer}
+
+    succeeded = 0
+    try:
+        items = await asyncio.gather(*(run_item(index, image_data) for index, image_data in enumerate(request.images)))
+        succeeded = sum(1 for item in items if item["status"] == 200)
+    finally:
+        # One aggregated update for the whole batch; anything not delivered goes back to the quota.
+        usage_tracker.commit(user, succeeded)
+        usage_tracker.refund(user, count - succeeded)
+
+    return {"results": items, "succeeded": succeeded, "failed": count - succeeded}
+
+def _format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class _StreamSettlement:
+    """Commits or refunds the reservation of a streamed call, exactly once."""
+
+    def __init__(self, user: dict, timings):
+        self.user = user
+        self.timings = timings
+        self.settled = False
+
+    def settle(self, outcome: str):
+        if self.settled:
+            return
+        self.settled = True
+        # Only a fully delivered answer counts against the quota.
+        if outcome == "ok":
+            usage_tracker.commit(self.user)
+        else:
+            usage_tracker.refund(self.user)
+        usage_analytics.record(self.user, "analyze_stream", outcome, self.timings)
+
+    async def abandon(self):
+        # Async, so Starlette runs it on the event loop rather than in a thread.
+        self.settle("cancelled")
+
+async def _sse_stream(settlement: _StreamSettlement, first_event, events):
+    user = settlement.user
+    # A client that disconnects mid-answer leaves the outcome at "cancelled".
+    outcome = "cancelled"
+    try:
+        yield _format_sse(*first_event)
+        async for event in events:
+            yield _format_sse(*event)
+        outcome = "ok"
+    except Exception as e:
+        outcome = "upstream_error"
+        logger.warning("External LLM API error during streaming", extra={"user_id": user["_id"], "error": str(e)})
+        yield _format_sse("error", {"detail": UPSTREAM_ERROR_DETAIL})
+    finally:
+        # Settled before the first await: on a disconnect this task is already cancelled,
+        # and the await would be interrupted before reaching anything after it.
+        settlement.settle(outcome)
+        await events.aclose()
+
+@router.post("/analyze/stream", dependencies=[Depends(check_api_status)])
+async def analyze_screen_stream(request: AnalysisRequest, admission: Admission = Depends(admission_control)):
+    """
+    Opt-in streaming variant of /analyze. Responds with Server-Sent Events: a
+    `classifier` event carrying the [OPTION:X]/[CODE] tag as soon as it is known,
+    `token` events with the answer text, and a final `done` event with the full result.
+    """
+    timings = start_request_timings()
+    user = await _authorize_analysis(request.access_key, request.device_key, admission)
+    try:
+        image_bytes = decode_image_data(request.image_data)
+    except InvalidImageError as image_error:
+        usage_analytics.record(user, "analyze_stream", "invalid_image")
+        raise HTTPException(status_code=400, detail=str(image_error))
+
+    if not usage_tracker.reserve(user):
+        usage_analytics.record(user, "analyze_stream", "quota_exceeded")
+        raise HTTPException(status_code=429, detail="API call limit reached for this key.")
+
+    ixl_config = LLMConfig(**user.get("ixl_config", {}))
+    txl_config = LLMConfig(**user.get("txl_config", {}))
+    events = stream_analysis(image_bytes, ixl_config, txl_config, user.get("pipeline_mode", "two_stage"))
+    # Wait for the first event before committing to a 200, so an upstream that is
+    # down still gets the same 503 as the non-streaming endpoint.
+    try:
+        first_event = await events.__anext__()
+    except Exception as llm_error:
+        usage_tracker.refund(user)
+        usage_analytics.record(user, "analyze_stream", "upstream_error")
+        logger.warning("External LLM API error", extra={"user_id": user["_id"], "error": str(llm_error)})
+        raise HTTPException(status_code=503, detail=UPSTREAM_ERROR_DETAIL)
+
+    settlement = _StreamSettlement(user, timings)
+    return StreamingResponse(
+        _sse_stream(settlement, first_event, events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Releases the reservation if the client left before the body was ever iterated.
+        background=BackgroundTask(settlement.abandon),
+    )
+
 @router.post("/auth/validate")
 async def validate_key(request: Request):
     try:
@@ -73,30 +290,34 @@ async def validate_key(request: Request):
     access_key = body.get("access_key")
     if not access_key:
         return {"is_valid": False}
-    user = await user_collection.find_one({"access_key": access_key})
+    user = await get_user_by_access_key(access_key)
     if not user or not user.get("is_active"):
         return {"is_valid": False}
     return {"is_valid": True}
 
 @router.post("/client/check-notifications", dependencies=[Depends(check_api_status)])
 async def check_notifications(request: SecureRequest):
-    user = await user_collection.find_one(
-        {"access_key": request.access_key, "device_key": request.device_key},
-        {"pending_notification": 1}
-    )
-    if not user or not user.get("pending_notification"):
+    user = await get_user_by_access_key(request.access_key)
+    if not user or user.get("device_key") != request.device_key or not user.get("pending_notification"):
         return {"message": None}
     message = user["pending_notification"]
-    await user_collection.update_one({"_id": user["_id"]}, {"$set": {"pending_notification": None}})
+    # Only the message still stored is delivered, so concurrent polls do not both show it
+    # and one an admin queued in the meantime is not cleared unseen.
+    result = await user_collection.update_one(
+        {"_id": user["_id"], "pending_notification": message},
+        {"$set": {"pending_notification": None}}
+    )
+    if result.modified_count != 1:
+        # Delivered elsewhere or replaced; the next poll reads what is stored now.
+        evict_user(access_key=request.access_key)
+        return {"message": None}
+    update_cached_user(request.access_key, {"pending_notification": None})
     return {"message": message}
 
 @router.post("/client/check-status", dependencies=[Depends(check_api_status)])
 async def check_client_status(request: SecureRequest):
-    user = await user_collection.find_one(
-        {"access_key": request.access_key, "device_key": request.device_key},
-        {"is_active": 1, "uninstall_pending": 1}
-    )
-    if not user:
+    user = await get_user_by_access_key(request.access_key)
+    if not user or user.get("device_key") != request.device_key:
         return {"action": "ok"}
     if user.get("uninstall_pending"):
         return {"action": "uninstall"}
@@ -0,0 +1,100 @@
+import asyncio
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+
+from .dependencies import get_unavailable_reason
+from core.config import EVENT_RECHECK_SECONDS
+from core.config_manager import get_system_config
+from core.database import user_collection
+from core.user_cache import get_user_by_access_key, get_user_for_device, update_cached_user
+from services.events import event_hub
+
+router = APIRouter()
+
+# How long a new connection has to send its credentials.
+AUTH_TIMEOUT_SECONDS = 10
+
+def _client_action(user: dict) -> str:
+    if user.get("uninstall_pending"):
+        return "uninstall"
+    if not user.get("is_active"):
+        return "block"
+    return "ok"
+
+async def _push_changes(websocket: WebSocket, access_key: str, device_key: str, sent: dict) -> bool:
+    """Sends whatever changed since the last push. Returns False once the device is no longer valid."""
+    reason = get_unavailable_reason(await get_system_config())
+    service_status = {"type": "status", "available": reason is None, "message": reason}
+    if service_status != sent.get("status"):
+        await websocket.send_json(service_status)
+        sent["status"] = service_status
+
+    user = await get_user_by_access_key(access_key)
+    if not user or user.get("device_key") != device_key:
+        return False
+
+    action = _client_action(user)
+    if action != sent.get("action"):
+        await websocket.send_json({"type": "action", "action": action})
+        sent["action"] = action
+
+    message = user.get("pending_notification")
+    if message:
+        await websocket.send_json({"type": "notification", "message": message})
+        # Only clear the message we delivered, not one an admin queued in the meantime.
+        await user_collection.update_one(
+            {"_id": user["_id"], "pending_notification": message},
+            {"$set": {"pending_notification": None}}
+        )
+        update_cached_user(access_key, {"pending_notification": None})
+    return True
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    # Clients do not need to send anything after authenticating; this only notices when they leave.
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        return
+
+@router.websocket("/client/events")
+async def client_events(websocket: WebSocket):
+    """
+    Push channel replacing /client/check-notifications and /client/check-status polling.
+    The client sends {"access_key", "device_key"} once, then receives JSON events:
+    {"type": "status"} for maintenance changes, {"type": "action"} for ok/block/uninstall
+    and {"type": "notification"} for admin messages.
+    """
+    await websocket.accept()
+    try:
+        credentials = await asyncio.wait_for(websocket.receive_json(), timeout=AUTH_TIMEOUT_SECONDS)
+        access_key = credentials["access_key"]
+        device_key = credentials["device_key"]
+    except (asyncio.TimeoutError, WebSocketDisconnect, KeyError, TypeError, ValueError):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    user = await get_user_for_device(access_key, device_key)
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    user_id = str(user["_id"])
+    wakeup = event_hub.subscribe(user_id)
+    disconnected = asyncio.create_task(_wait_for_disconnect(websocket))
+    sent = {}
+    try:
+        while True:
+            wakeup.clear()
+            if not await _push_changes(websocket, access_key, device_key, sent):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                break
+            woken = asyncio.create_task(wakeup.wait())
+            done, _ = await asyncio.wait({woken, disconnected}, timeout=EVENT_RECHECK_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            woken.cancel()
+            if disconnected in done:
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_hub.unsubscribe(user_id, wakeup)
+        disconnected.cancel()
@@ -1,42 +1,77 @@
 from fastapi import HTTPException, status
-from core.config_manager import get_system_config
-from datetime import datetime, time
+from core.config_manager import get_system_config, SystemConfig
+from core.metrics import ANALYZE_STAGE_DURATION
+from services.admission import admission_controller, AdmissionRejected
+from datetime import datetime
+from typing import Optional
+import math
 import pytz
 
+def get_unavailable_reason(config: SystemConfig) -> Optional[str]:
+    """Returns the maintenance message if the API is currently disabled, otherwise None."""
+    if not config.api_enabled:
+        return config.maintenance_message or "The service is temporarily disabled by an administrator."
+
+    if config.is_in_lockdown(datetime.now(pytz.utc).time()):
+        return config.maintenance_message or "The service is currently in a scheduled maintenance window."
+
+    return None
+
 async def check_api_status():
     """
     A FastAPI dependency that checks if the API is globally enabled,
     both manually and via a recurring daily schedule.
+    The config is served from the in-process cache, so this normally costs no database round trip.
     """
-    config = await get_system_config()
-    
-    if not config.api_enabled:
+    with ANALYZE_STAGE_DURATION.time(stage="config_gate"):
+        config = await get_system_config()
+
+    reason = get_unavailable_reason(config)
+    if reason:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail=config.maintenance_message or "The service is temporarily disabled by an administrator."
+            detail=reason
         )
-        
-    if config.daily_lockdown_start_utc and config.daily_lockdown_end_utc:
-        try:
-            now_utc_time = datetime.now(pytz.utc).time()
-
-            start_time = time.fromisoformat(config.daily_lockdown_start_utc)
-            end_time = time.fromisoformat(config.daily_lockdown_end_utc)
-
-            is_locked = False
-            if start_time <= end_time:
-                if start_time <= now_utc_time <= end_time:
-                    is_locked = True
-            else: 
-                if now_utc_time >= start_time or now_utc_time <= end_time:
-                    is_locked = True
-            
-            if is_locked:
+
+    return True
+
+class Admission:
+    """
+    Handed to an analysis endpoint by `admission_control`. The endpoint calls admit()
+    once the credentials have been verified, so only a real user's rate budget and
+    slots are charged, and the request body is never read here.
+    """
+
+    def __init__(self):
+        self.held = []
+        # Calls the request may run at once; only batches ask for more than one.
+        self.parallelism = 1
+
+    async def admit(self, user: dict, cost: int = 1, parallelism: int = 1):
+        with ANALYZE_STAGE_DURATION.time(stage="admission"):
+            config = await get_system_config()
+            try:
+                self.held = await admission_controller.admit(user, config, cost)
+            except AdmissionRejected as rejected:
                 raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=config.maintenance_message or "The service is currently in a scheduled maintenance window."
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail=rejected.detail,
+                    headers={"Retry-After": str(max(1, math.ceil(rejected.retry_after)))}
                 )
-        except (ValueError, TypeError):
-            print("Warning: Invalid daily lockdown time format in database. Skipping schedule check.")
-    
-    return True
\ No newline at end of file
+            if parallelism > 1:
+                # Beyond the first slot, a batch only runs as wide as the slots that are free right now.
+                extra, taken = await admission_controller.acquire_more(user, config, parallelism - 1)
+                self.held += extra
+                self.parallelism = 1 + taken
+
+async def admission_control():
+    """
+    A FastAPI dependency applying rate limits and concurrency caps to the analysis
+    endpoints. Over-limit requests get a 429 with Retry-After; admitted ones hold
+    their slots until the response, including a streamed one, has been sent.
+    """
+    admission = Admission()
+    try:
+        yield admission
+    finally:
+        await admission_controller.release(admission.held)
\ No newline at end of file
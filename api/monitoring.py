@@ -0,0 +1,42 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from core.config import MONGO_MAX_POOL_SIZE
+from core.database import ping_database
+from core.metrics import render_metrics, HTTP_IN_FLIGHT, MONGO_POOL_CONNECTIONS, MONGO_POOL_CHECKED_OUT
+from services.http_client import client_origins
+from services.image_processing import image_pool_size
+from services.resilience import upstream_health
+
+router = APIRouter()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus scrape endpoint. Values are per worker process."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@router.get("/ready")
+async def readiness(request: Request):
+    """
+    Readiness probe: 200 once this worker has warmed up and MongoDB answers,
+    503 while starting, draining or cut off from the database.
+    """
+    serving = getattr(request.app.state, "serving", "starting")
+    mongo_reachable = await ping_database()
+    ready = serving == "ready" and mongo_reachable
+    report = {
+        "status": serving if serving != "ready" else ("ready" if mongo_reachable else "degraded"),
+        "mongo": {
+            "reachable": mongo_reachable,
+            "pool_connections": MONGO_POOL_CONNECTIONS.value(),
+            "pool_checked_out": MONGO_POOL_CHECKED_OUT.value(),
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+        },
+        "upstreams": {
+            "connected_hosts": client_origins(),
+            "open_circuits": [f"{h['base_url']} ({h['model_id']})" for h in upstream_health() if h["open"]],
+        },
+        "image_pool_workers": image_pool_size(),
+        "requests_in_flight": HTTP_IN_FLIGHT.value(),
+    }
+    return JSONResponse(report, status_code=200 if ready else 503)
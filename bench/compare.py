@@ -0,0 +1,70 @@
+# bench/compare.py
+"""
+Compares two bench/run.py reports and exits non-zero when the candidate
+regressed beyond the tolerance on throughput, tail latency or memory.
+
+    python -m bench.compare baseline.json candidate.json --tolerance 0.10
+"""
+
+import argparse
+import json
+import sys
+
+# (path in the scenario report, True if higher is better)
+_CHECKS = (
+    (("rps",), True),
+    (("success_rate",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("memory", "peak_bytes_per_in_flight_request"), False),
+    (("memory", "retained_bytes_per_request"), False),
+)
+
+
+def _lookup(report: dict, path: tuple):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+
+def compare(baseline: dict, candidate: dict, tolerance: float) -> list:
+    """Returns one row per scenario and metric: (scenario, metric, baseline, candidate, change, regressed)."""
+    rows = []
+    for scenario, base_result in baseline.get("scenarios", {}).items():
+        new_result = candidate.get("scenarios", {}).get(scenario)
+        if new_result is None:
+            continue
+        for path, higher_is_better in _CHECKS:
+            old, new = _lookup(base_result, path), _lookup(new_result, path)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            rows.append((scenario, ".".join(path), old, new, change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative change before a metric counts as regressed.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.tolerance)
+    for scenario, metric, old, new, change, regressed in rows:
+        marker = "REGRESSED" if regressed else "ok"
+        print(f"{scenario:<16} {metric:<40} {old:>14} -> {new:<14} {change:+8.1%}  {marker}")
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+# bench/fake_mongo.py
+"""
+In-memory stand-in for the Motor client, for benchmarks only.
+
+`install()` registers a fake `motor.motor_asyncio` module before the app is
+imported, so `core.database` builds its collections on top of it. It supports
+the query and update operators the app uses and can add a fixed per-operation
+delay to emulate a network round trip to Mongo.
+"""
+
+import asyncio
+import copy
+import re
+import sys
+import types
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, InsertManyResult, UpdateResult
+
+_MISSING = object()
+
+# Seconds added to every operation; set by install().
+OPERATION_DELAY = 0.0
+
+
+def _get_path(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set_path(doc: dict, path: str, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _compare(value, op: str, operand) -> bool:
+    if op == "$eq":
+        return value is not _MISSING and value == operand or (value is _MISSING and operand is None)
+    if op == "$ne":
+        return not _compare(value, "$eq", operand)
+    if op == "$in":
+        return any(_compare(value, "$eq", item) for item in operand)
+    if op == "$nin":
+        return not _compare(value, "$in", operand)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if op == "$regex":
+        return isinstance(value, str) and re.search(operand, value) is not None
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        return False
+    raise NotImplementedError(f"Query operator {op} is not supported by the fake collection.")
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = _get_path(doc, key)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif not _compare(value, "$eq", condition):
+            return False
+    return True
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    included = {key for key, flag in projection.items() if flag}
+    if included:
+        result = {"_id": doc["_id"]} if projection.get("_id", 1) else {}
+        for key in included:
+            value = _get_path(doc, key)
+            if value is not _MISSING:
+                _set_path(result, key, copy.deepcopy(value))
+        return result
+    result = copy.deepcopy(doc)
+    for key in projection:
+        _unset_path(result, key)
+    return result
+
+
+def _apply_update(doc: dict, update: dict, inserting: bool = False):
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                _set_path(doc, path, copy.deepcopy(value))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_path(doc, path, copy.deepcopy(value))
+            elif op == "$inc":
+                current = _get_path(doc, path)
+                _set_path(doc, path, (0 if current is _MISSING else current) + value)
+            elif op == "$max":
+                current = _get_path(doc, path)
+                _set_path(doc, path, value if current is _MISSING else max(current, value))
+            elif op == "$min":
+                current = _get_path(doc, path)
+                _set_path(doc, path, value if current is _MISSING else min(current, value))
+            elif op == "$unset":
+                _unset_path(doc, path)
+            else:
+                raise NotImplementedError(f"Update operator {op} is not supported by the fake collection.")
+
+
+def _upsert_seed(query: dict) -> dict:
+    """Equality fields of a filter become fields of the upserted document, as in Mongo."""
+    seed = {}
+    for key, condition in query.items():
+        if not key.startswith("$") and not (isinstance(condition, dict) and any(k.startswith("$") for k in condition)):
+            _set_path(seed, key, copy.deepcopy(condition))
+    return seed
+
+
+class FakeCursor:
+    def __init__(self, docs: List[dict]):
+        self._docs = docs
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._sort = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def _results(self) -> List[dict]:
+        docs = self._docs
+        for key, direction in reversed(self._sort or []):
+            docs = sorted(docs, key=lambda d: (_get_path(d, key) is _MISSING, _get_path(d, key)), reverse=direction < 0)
+        docs = docs[self._skip:]
+        return docs[:self._limit] if self._limit else docs
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        await _delay()
+        results = self._results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await _delay()
+        for doc in self._results():
+            yield doc
+
+
+class FakeCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self._docs: Dict[Any, dict] = {}
+        self._unique_fields: List[str] = []
+
+    def _check_unique(self, doc: dict, ignore_id=None):
+        for field in self._unique_fields:
+            value = _get_path(doc, field)
+            if value is _MISSING:
+                continue
+            for other in self._docs.values():
+                if other["_id"] != ignore_id and _get_path(other, field) == value:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {field}")
+
+    def _insert(self, doc: dict):
+        doc = copy.deepcopy(doc)
+        if "_id" not in doc:
+            doc["_id"] = f"{self.name}-{len(self._docs) + 1}"
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        self._check_unique(doc)
+        self._docs[doc["_id"]] = doc
+        return doc["_id"]
+
+    def _find_docs(self, query: Optional[dict]) -> List[dict]:
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self._docs.get(query["_id"])
+            return [doc] if doc is not None and _matches(doc, query) else []
+        return [doc for doc in self._docs.values() if _matches(doc, query)]
+
+    def _update(self, query: dict, update: dict, upsert: bool, many: bool):
+        docs = self._find_docs(query)
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            _apply_update(doc, update)
+        if docs or not upsert:
+            return len(docs), None
+        doc = _upsert_seed(query)
+        _apply_update(doc, update, inserting=True)
+        return 0, self._insert(doc)
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        await _delay()
+        docs = self._find_docs(query)
+        return _project(docs[0], projection) if docs else None
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None, batch_size: int = 0, **kwargs) -> FakeCursor:
+        return FakeCursor([_project(doc, projection) for doc in self._find_docs(query)])
+
+    async def count_documents(self, query: dict, **kwargs) -> int:
+        await _delay()
+        return len(self._find_docs(query))
+
+    async def distinct(self, key: str, query: Optional[dict] = None, **kwargs) -> list:
+        await _delay()
+        values = []
+        for doc in self._find_docs(query):
+            value = _get_path(doc, key)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+        return values
+
+    async def insert_one(self, doc: dict, **kwargs) -> InsertOneResult:
+        await _delay()
+        return InsertOneResult(self._insert(doc), True)
+
+    async def insert_many(self, docs: List[dict], ordered: bool = True, **kwargs) -> InsertManyResult:
+        await _delay()
+        return InsertManyResult([self._insert(doc) for doc in docs], True)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        await _delay()
+        matched, upserted_id = self._update(query, update, upsert, many=False)
+        return UpdateResult({"n": matched or int(upserted_id is not None), "nModified": matched, "upserted": upserted_id}, True)
+
+    async def update_many(self, query: dict, update: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        await _delay()
+        matched, upserted_id = self._update(query, update, upsert, many=True)
+        return UpdateResult({"n": matched or int(upserted_id is not None), "nModified": matched, "upserted": upserted_id}, True)
+
+    async def replace_one(self, query: dict, replacement: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        await _delay()
+        docs = self._find_docs(query)
+        if docs:
+            replacement = {**copy.deepcopy(replacement), "_id": docs[0]["_id"]}
+            self._docs[docs[0]["_id"]] = replacement
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+        if upsert:
+            upserted_id = self._insert({**_upsert_seed(query), **replacement})
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": upserted_id}, True)
+        return UpdateResult({"n": 0, "nModified": 0}, True)
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None, upsert: bool = False, return_document: bool = False, **kwargs):
+        await _delay()
+        docs = self._find_docs(query)
+        if not docs:
+            if not upsert:
+                return None
+            _, upserted_id = self._update(query, update, upsert=True, many=False)
+            return _project(self._docs[upserted_id], projection) if return_document else None
+        before = _project(docs[0], projection)
+        _apply_update(docs[0], update)
+        return _project(docs[0], projection) if return_document else before
+
+    async def delete_one(self, query: dict, **kwargs) -> DeleteResult:
+        await _delay()
+        docs = self._find_docs(query)[:1]
+        for doc in docs:
+            del self._docs[doc["_id"]]
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def delete_many(self, query: dict, **kwargs) -> DeleteResult:
+        await _delay()
+        docs = self._find_docs(query)
+        for doc in docs:
+            del self._docs[doc["_id"]]
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        await _delay()
+        counts = defaultdict(int)
+        upserted = []
+        write_errors = []
+        for index, request in enumerate(requests):
+            kind = type(request).__name__
+            try:
+                if kind == "InsertOne":
+                    self._insert(request._doc)
+                    counts["nInserted"] += 1
+                elif kind in ("UpdateOne", "UpdateMany"):
+                    matched, upserted_id = self._update(request._filter, request._doc, request._upsert, many=kind == "UpdateMany")
+                    counts["nMatched"] += matched
+                    counts["nModified"] += matched
+                    if upserted_id is not None:
+                        counts["nUpserted"] += 1
+                        upserted.append({"index": index, "_id": upserted_id})
+                elif kind == "DeleteOne":
+                    counts["nRemoved"] += (await self.delete_one(request._filter)).deleted_count
+                else:
+                    raise NotImplementedError(f"Bulk operation {kind} is not supported by the fake collection.")
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        details = {**counts, "upserted": upserted, "writeErrors": write_errors}
+        if write_errors:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+    async def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        await _delay()
+        if unique and isinstance(keys, str):
+            self._unique_fields.append(keys)
+        return kwargs.get("name") or str(keys)
+
+    def watch(self, *args, **kwargs):
+        # Standalone servers do not support change streams either; the app falls back to polling.
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def get_collection(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name)
+        return self._collections[name]
+
+    __getitem__ = get_collection
+
+    async def command(self, command, *args, **kwargs):
+        await _delay()
+        return {"ok": 1.0}
+
+
+class FakeMotorClient:
+    def __init__(self, *args, **kwargs):
+        self._databases: Dict[str, FakeDatabase] = {}
+        self.admin = FakeDatabase()
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        if name not in self._databases:
+            self._databases[name] = FakeDatabase()
+        return self._databases[name]
+
+    get_database = __getitem__
+
+    def close(self):
+        pass
+
+
+async def _delay():
+    if OPERATION_DELAY:
+        await asyncio.sleep(OPERATION_DELAY)
+
+
+def install(operation_delay_ms: float = 0.0):
+    """Makes `motor.motor_asyncio.AsyncIOMotorClient` resolve to the in-memory fake. Call before importing the app."""
+    global OPERATION_DELAY
+    OPERATION_DELAY = operation_delay_ms / 1000
+    motor = types.ModuleType("motor")
+    motor_asyncio = types.ModuleType("motor.motor_asyncio")
+    motor_asyncio.AsyncIOMotorClient = FakeMotorClient
+    motor.motor_asyncio = motor_asyncio
+    sys.modules["motor"] = motor
+    sys.modules["motor.motor_asyncio"] = motor_asyncio
@@ -0,0 +1,114 @@
+# bench/fake_upstream.py
+"""
+Local OpenAI-compatible chat completions server standing in for the IXL/TXL
+providers during benchmarks. Latency and failure rate are configurable so
+slow or flaky providers can be reproduced.
+
+    python -m bench.fake_upstream --port 8900 --latency-ms 300 --jitter-ms 100 --failure-rate 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+import uvicorn
+
+# Canned replies: IXL gets a description, TXL and the fused mode get a tagged answer.
+_DESCRIPTION = "A multiple choice question asking which planet is closest to the sun. Options: A) Venus B) Mercury C) Earth D) Mars."
+_ANSWER = "[OPTION:B]The correct answer is <answer>B</answer>: Mercury orbits closest to the sun."
+
+
+class FakeUpstream:
+    def __init__(self, latency_ms: float = 200, jitter_ms: float = 50, failure_rate: float = 0.0, stream_chunks: int = 8, seed: int = None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.failure_rate = failure_rate
+        self.stream_chunks = max(stream_chunks, 1)
+        self._random = random.Random(seed)
+
+    def _delay(self) -> float:
+        return max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await receive()
+            await send({"type": "lifespan.startup.complete"})
+            await receive()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        if scope["method"] != "POST" or not scope["path"].endswith("/chat/completions"):
+            await self._send_json(send, 404, {"error": {"message": "Not found"}})
+            return
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            await self._send_json(send, 400, {"error": {"message": "Invalid JSON"}})
+            return
+
+        delay = self._delay()
+        if self._random.random() < self.failure_rate:
+            await asyncio.sleep(delay)
+            await self._send_json(send, 503, {"error": {"message": "Simulated upstream failure"}})
+            return
+
+        # TXL and fused requests carry the answering system prompt; IXL only asks for a description.
+        messages = payload.get("messages", [])
+        content = _ANSWER if any(m.get("role") == "system" for m in messages) else _DESCRIPTION
+        usage = {"prompt_tokens": len(body) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(body) + len(content)) // 4}
+
+        if payload.get("stream"):
+            await self._stream(send, payload, content, usage, delay)
+            return
+        await asyncio.sleep(delay)
+        await self._send_json(send, 200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    async def _stream(self, send, payload, content, usage, delay):
+        # Time to first token takes half the delay, the remaining chunks share the rest.
+        await asyncio.sleep(delay / 2)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        size = -(-len(content) // self.stream_chunks)
+        for start in range(0, len(content), size):
+            chunk = {"id": "chatcmpl-bench", "model": payload.get("model"), "choices": [{"index": 0, "delta": {"content": content[start:start + size]}}]}
+            await send({"type": "http.response.body", "body": f"data: {json.dumps(chunk)}\n\n".encode(), "more_body": True})
+            await asyncio.sleep(delay / 2 / self.stream_chunks)
+        final = {"id": "chatcmpl-bench", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        await send({"type": "http.response.body", "body": f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode()})
+
+    @staticmethod
+    async def _send_json(send, status: int, data: dict):
+        body = json.dumps(data).encode()
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible upstream for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    app = FakeUpstream(args.latency_ms, args.jitter_ms, args.failure_rate, args.stream_chunks, args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", backlog=4096)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# bench/run.py
+"""
+Load scenarios against `main.app`, with the IXL/TXL providers replaced by
+bench/fake_upstream.py and MongoDB by the in-memory collections of
+bench/fake_mongo.py. Requests go through httpx's ASGI transport, so the
+numbers cover the app itself rather than a network stack.
+
+    python -m bench.run --scenario all --requests 2000 --concurrency 50 --output bench_results.json
+    python -m bench.compare baseline.json bench_results.json
+
+Each scenario runs twice: a timed pass for throughput and latency, then a
+shorter pass under tracemalloc for memory, so allocation tracing does not skew
+the latency numbers.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_KEY = "bench-admin-key"
+
+SCENARIOS = ("analyze", "analyze_cached", "analyze_raw", "analyze_stream", "analyze_batch", "poll", "admin")
+# Images per /analyze/batch request.
+BATCH_SIZE = 4
+
+
+def _gradient_rows(width: int, height: int) -> List[bytes]:
+    return [
+        b"\x00" + bytes(value for x in range(width) for value in (x * 255 // width, y * 255 // height, (x + y) % 256))
+        for y in range(height)
+    ]
+
+
+def _make_png(rows: List[bytes], width: int, height: int, seed: int) -> bytes:
+    """A valid RGB PNG: a gradient with one row of seeded noise so every image hashes differently."""
+    rng = random.Random(seed)
+    noisy = list(rows)
+    noisy[height // 2] = b"\x00" + rng.randbytes(width * 3)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(noisy), 6)) + chunk(b"IEND", b"")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_upstream(args) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.fake_upstream", "--port", str(args.upstream_port),
+         "--latency-ms", str(args.upstream_latency_ms), "--jitter-ms", str(args.upstream_jitter_ms),
+         "--failure-rate", str(args.upstream_failure_rate), "--seed", str(args.seed)],
+        cwd=REPO_ROOT,
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.upstream_port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Fake upstream did not start.")
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def _drive(client, make_request: Callable[[object, int], Awaitable], total: int, concurrency: int, start: int = 0):
+    """Runs `total` requests with `concurrency` workers; returns per-request latencies and status codes."""
+    latencies, statuses = [], Counter()
+    next_index = start
+
+    async def worker():
+        nonlocal next_index
+        while next_index < start + total:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await make_request(client, index)
+                statuses[str(response.status_code)] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, statuses
+
+
+class Scenarios:
+    """Request factories for each scenario, sharing the seeded users and images."""
+
+    def __init__(self, users: List[dict], width: int, height: int):
+        self.users = users
+        self.width = width
+        self.height = height
+        self._rows = _gradient_rows(width, height)
+        self.images: List[bytes] = []
+        self._encoded: List[str] = []
+
+    def load_images(self, count: int, seed: int):
+        """Fresh images per scenario, so one scenario never hits results another one cached."""
+        self.images = [_make_png(self._rows, self.width, self.height, seed + index) for index in range(count)]
+        self._encoded = [base64.b64encode(image).decode() for image in self.images]
+
+    def _user(self, index: int) -> dict:
+        return self.users[index % len(self.users)]
+
+    async def analyze(self, client, index):
+        user = self._user(index)
+        return await client.post("/analyze", json={
+            "access_key": user["access_key"], "device_key": user["device_key"],
+            "image_data": self._encoded[index % len(self._encoded)],
+        })
+
+    async def analyze_cached(self, client, index):
+        user = self._user(index)
+        return await client.post("/analyze", json={
+            "access_key": user["access_key"], "device_key": user["device_key"], "image_data": self._encoded[0],
+        })
+
+    async def analyze_raw(self, client, index):
+        user = self._user(index)
+        return await client.post(
+            "/analyze/raw",
+            content=self.images[index % len(self.images)],
+            headers={"X-Access-Key": user["access_key"], "X-Device-Key": user["device_key"], "Content-Type": "application/octet-stream"},
+        )
+
+    async def analyze_stream(self, client, index):
+        user = self._user(index)
+        return await client.post("/analyze/stream", json={
+            "access_key": user["access_key"], "device_key": user["device_key"],
+            "image_data": self._encoded[index % len(self._encoded)],
+        })
+
+    async def analyze_batch(self, client, index):
+        user = self._user(index)
+        return await client.post("/analyze/batch", json={
+            "access_key": user["access_key"], "device_key": user["device_key"],
+            "images": [self._encoded[(index * BATCH_SIZE + offset) % len(self._encoded)] for offset in range(BATCH_SIZE)],
+        })
+
+    async def poll(self, client, index):
+        user = self._user(index)
+        path = "/client/check-status" if index % 2 else "/client/check-notifications"
+        return await client.post(path, json={"access_key": user["access_key"], "device_key": user["device_key"]})
+
+    async def admin(self, client, index):
+        headers = {"X-Admin-API-Key": ADMIN_KEY}
+        user = self._user(index)
+        kind = index % 4
+        if kind == 0:
+            return await client.get("/admin/users/page", params={"limit": 100, "fields": "username,is_active,api_calls_total"}, headers=headers)
+        if kind == 1:
+            return await client.put(f"/admin/users/{user['_id']}", json={"api_call_limit": 100000 + index}, headers=headers)
+        if kind == 2:
+            return await client.post(f"/admin/users/{user['_id']}/notify", json={"message": f"bench {index}"}, headers=headers)
+        return await client.get("/admin/system-config", headers=headers)
+
+
+async def _seed_users(args) -> List[dict]:
+    from core.database import user_collection
+    from models.user import User
+
+    upstream = {"api_key": "bench", "base_url": f"http://127.0.0.1:{args.upstream_port}/v1/chat/completions"}
+    users = []
+    for index in range(args.users):
+        user = User(
+            username=f"bench-{index:05d}",
+            access_key=f"bkmstr_bench_{index:05d}",
+            ixl_config={**upstream, "model_id": "bench-ixl"},
+            txl_config={**upstream, "model_id": "bench-txl"},
+            pipeline_mode=args.pipeline_mode,
+        ).model_dump(by_alias=True)
+        user["device_key"] = f"bkm_dev_bench_{index:05d}"
+        await user_collection.insert_one(user)
+        users.append(user)
+    return users
+
+
+async def _run_scenario(client, scenarios: Scenarios, name: str, seed: int, args) -> dict:
+    make_request = getattr(scenarios, name)
+    memory_requests = min(args.memory_requests, args.requests)
+    if name.startswith("analyze"):
+        # Every request of the scenario gets its own image, derived from the seed so runs are comparable.
+        scenarios.load_images(args.warmup + args.requests + memory_requests, seed)
+
+    # Warm caches and connection pools so the first requests do not dominate the tail.
+    await _drive(client, make_request, args.warmup, min(args.concurrency, max(args.warmup, 1)))
+
+    started = time.perf_counter()
+    latencies, statuses = await _drive(client, make_request, args.requests, args.concurrency, start=args.warmup)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    await _drive(client, make_request, memory_requests, args.concurrency, start=args.warmup + args.requests)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 4),
+        "rps": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "success_rate": round(ok / args.requests, 4) if args.requests else 0.0,
+        "status_counts": dict(sorted(statuses.items())),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p90": round(_percentile(latencies, 0.90) * 1000, 3),
+            "p95": round(_percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "memory": {
+            "traced_requests": memory_requests,
+            # Peak allocations above the starting point, shared by the requests in flight at that moment.
+            "peak_bytes_per_in_flight_request": int((peak - baseline) / min(args.concurrency, memory_requests)) if memory_requests else 0,
+            # What the pass left behind (caches, buffers); steady growth here points at a leak.
+            "retained_bytes_per_request": int((current - baseline) / memory_requests) if memory_requests else 0,
+        },
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def _main(args) -> dict:
+    import httpx
+    import main
+
+    users = await _seed_users(args)
+    scenarios = Scenarios(users, args.image_width, args.image_height)
+
+    results: Dict[str, dict] = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            for position, name in enumerate(args.scenarios):
+                results[name] = await _run_scenario(client, scenarios, name, args.seed + position * 1_000_000, args)
+                print(f"{name}: {results[name]['rps']} rps, p99 {results[name]['latency_ms']['p99']} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            "settings": {key: value for key, value in vars(args).items() if key != "scenarios"},
+        },
+        "scenarios": results,
+    }
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark main.app with fake upstream and Mongo.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS + ("all",), help="Repeatable; defaults to all.")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--memory-requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--pipeline-mode", choices=("two_stage", "fused"), default="two_stage")
+    parser.add_argument("--image-width", type=int, default=320)
+    parser.add_argument("--image-height", type=int, default=180)
+    parser.add_argument("--upstream-port", type=int, default=0, help="0 picks a free port.")
+    parser.add_argument("--upstream-latency-ms", type=float, default=200)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=50)
+    parser.add_argument("--upstream-failure-rate", type=float, default=0.0)
+    parser.add_argument("--mongo-latency-ms", type=float, default=0.5, help="Added to every fake Mongo operation.")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    selected = args.scenario or ["all"]
+    args.scenarios = list(SCENARIOS) if "all" in selected else list(dict.fromkeys(selected))
+    args.upstream_port = args.upstream_port or _free_port()
+    return args
+
+
+def main():
+    args = _parse_args()
+
+    # Settings the app reads at import time.
+    os.environ["ADMIN_API_KEY"] = ADMIN_KEY
+    os.environ.setdefault("MONGO_URI", "mongodb://bench.invalid")
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    sys.path.insert(0, REPO_ROOT)
+
+    from bench import fake_mongo
+    fake_mongo.install(args.mongo_latency_ms)
+
+    upstream = _start_upstream(args)
+    try:
+        report = asyncio.run(_main(args))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
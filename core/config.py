@@ -6,4 +6,102 @@ load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI")
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
-DATABASE_NAME = "buckminster_db"
\ No newline at end of file
+DATABASE_NAME = "buckminster_db"
+
+# Serving: worker processes started by `python main.py`, how long a worker keeps serving
+# after SIGTERM while /ready already reports draining, and how long it then lets in-flight
+# requests finish. Mongo pool limits apply per worker process.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHUTDOWN_PRESTOP_SECONDS = float(os.getenv("SHUTDOWN_PRESTOP_SECONDS", "5"))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SERVER_KEEPALIVE_SECONDS = int(os.getenv("SERVER_KEEPALIVE_SECONDS", "5"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+# Upstream hosts pre-connected at startup, and how long each attempt may take.
+WARMUP_MAX_UPSTREAMS = int(os.getenv("WARMUP_MAX_UPSTREAMS", "20"))
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "5"))
+
+# Outbound HTTP settings for the IXL/TXL providers.
+# One pooled client is kept per upstream host, so these limits apply per host.
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "45"))
+HTTP_POOL_TIMEOUT_SECONDS = float(os.getenv("HTTP_POOL_TIMEOUT_SECONDS", "10"))
+
+# Upstream resilience. Attempts include retries, fallback endpoints and hedged requests;
+# retries of the same endpoint back off exponentially with full jitter.
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BASE_DELAY_SECONDS = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY_SECONDS", "0.2"))
+UPSTREAM_RETRY_MAX_DELAY_SECONDS = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY_SECONDS", "2"))
+# Time one upstream call may take across all of its attempts; each attempt gets what is left.
+UPSTREAM_CALL_BUDGET_SECONDS = float(os.getenv("UPSTREAM_CALL_BUDGET_SECONDS", "45"))
+# Consecutive failures that open a provider's circuit, and how long it stays open before a probe.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+# Default hedge delay for non-streaming calls; 0 disables hedging.
+UPSTREAM_HEDGE_AFTER_SECONDS = float(os.getenv("UPSTREAM_HEDGE_AFTER_SECONDS", "0"))
+# An endpoint whose average latency is this many times the fastest one's is tried after the others.
+UPSTREAM_SLOW_FACTOR = float(os.getenv("UPSTREAM_SLOW_FACTOR", "2"))
+
+# How long a worker may serve its cached SystemConfig before re-reading it.
+# Only used when no change stream is available to push updates.
+CONFIG_CACHE_TTL_SECONDS = float(os.getenv("CONFIG_CACHE_TTL_SECONDS", "5"))
+
+# Authenticated user records cached per worker, keyed by access_key.
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "15"))
+
+# Usage counters are buffered in memory and written to Mongo in batches this often.
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "2"))
+
+# Usage analytics: per-call events and hourly/daily rollups, written in batches this often.
+# Raw events and hourly rollups expire after the given number of days; daily rollups are kept.
+ANALYTICS_FLUSH_INTERVAL_SECONDS = float(os.getenv("ANALYTICS_FLUSH_INTERVAL_SECONDS", "5"))
+ANALYTICS_MAX_BUFFERED_EVENTS = int(os.getenv("ANALYTICS_MAX_BUFFERED_EVENTS", "10000"))
+USAGE_EVENTS_TTL_DAYS = int(os.getenv("USAGE_EVENTS_TTL_DAYS", "7"))
+USAGE_HOURLY_ROLLUP_TTL_DAYS = int(os.getenv("USAGE_HOURLY_ROLLUP_TTL_DAYS", "90"))
+
+# Results of identical /analyze submissions are reused for this long.
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "600"))
+# Also share results between workers through the analysis_cache collection.
+RESULT_CACHE_MONGO_ENABLED = os.getenv("RESULT_CACHE_MONGO_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Largest screenshot accepted by /analyze/raw, in bytes.
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+
+# /analyze/batch: most images per request, and how many of them run at once.
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "16"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "4"))
+
+# Screenshots are decoded, border-trimmed, downscaled and re-encoded in a process pool
+# before they are sent upstream. Format is "webp", "jpeg" or "png"; quality applies to the lossy ones.
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() in ("1", "true", "yes")
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "webp").lower()
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "85"))
+# Largest per-channel difference from the corner colour still treated as a uniform border.
+IMAGE_TRIM_TOLERANCE = int(os.getenv("IMAGE_TRIM_TOLERANCE", "8"))
+
+# Connected devices re-check their state this often even without a push event,
+# which covers changes made on workers that cannot see a change stream.
+EVENT_RECHECK_SECONDS = float(os.getenv("EVENT_RECHECK_SECONDS", "10"))
+
+# Upper bounds for the admin listing and bulk endpoints.
+ADMIN_PAGE_MAX_SIZE = int(os.getenv("ADMIN_PAGE_MAX_SIZE", "500"))
+ADMIN_BULK_MAX_ITEMS = int(os.getenv("ADMIN_BULK_MAX_ITEMS", "1000"))
+
+# Admission control state for the analysis endpoints: "memory" keeps it per worker,
+# "mongo" shares rate limits and concurrency slots between workers.
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", "memory").lower()
+# Shared concurrency slots expire after this long, so a crashed worker cannot leak them.
+ADMISSION_LEASE_SECONDS = float(os.getenv("ADMISSION_LEASE_SECONDS", "300"))
+# How often queued requests re-check shared slots freed on other workers.
+ADMISSION_POLL_SECONDS = float(os.getenv("ADMISSION_POLL_SECONDS", "0.05"))
+# Retry-After sent when a request is turned away for lack of a concurrency slot.
+ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
@@ -1,9 +1,17 @@
 # core/config_manager.py
 
+import asyncio
+from time import monotonic
 from .database import database
-from pydantic import BaseModel, Field
+from .config import CONFIG_CACHE_TTL_SECONDS
+from .log import get_logger
+from pydantic import BaseModel, Field, PrivateAttr
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, time
+
+logger = get_logger("config_manager")
 
 # Get a new collection dedicated to system configuration
 config_collection = database.get_collection("system_config")
@@ -14,25 +22,132 @@ class SystemConfig(BaseModel):
     # REMOVE old datetime fields
     # lockdown_start: Optional[datetime] = None
     # lockdown_end: Optional[datetime] = None
-    
+
     # ADD new time string fields
     daily_lockdown_start_utc: Optional[str] = None # e.g., "22:30"
     daily_lockdown_end_utc: Optional[str] = None   # e.g., "05:00"
 
     maintenance_message: Optional[str] = "The service is temporarily unavailable for maintenance. Please try again later."
 
-async def get_system_config() -> SystemConfig:
-    """Retrieves the global system configuration from the database."""
+    # Admission control defaults for the analysis endpoints; None means unlimited.
+    # Users can override the per-user limits on their own record.
+    rate_limit_per_minute: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
+    max_concurrent_per_user: Optional[int] = None
+    max_concurrent_global: Optional[int] = None
+    # Requests that may wait for a concurrency slot per worker, and for how long, before a 429.
+    admission_queue_size: int = 0
+    admission_queue_timeout_seconds: float = 2.0
+
+    # Bumped on every update so workers can tell which revision they are serving.
+    version: int = 0
+
+    # Lockdown window parsed once when the config is loaded, not on every request.
+    _lockdown_start: Optional[time] = PrivateAttr(default=None)
+    _lockdown_end: Optional[time] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        if self.daily_lockdown_start_utc and self.daily_lockdown_end_utc:
+            try:
+                self._lockdown_start = time.fromisoformat(self.daily_lockdown_start_utc)
+                self._lockdown_end = time.fromisoformat(self.daily_lockdown_end_utc)
+            except (ValueError, TypeError):
+                self._lockdown_start = self._lockdown_end = None
+                logger.warning("Invalid daily lockdown time format in database. Skipping schedule check.")
+
+    def is_in_lockdown(self, now_utc_time: time) -> bool:
+        """Checks the pre-parsed daily lockdown window against the given UTC time."""
+        start_time, end_time = self._lockdown_start, self._lockdown_end
+        if start_time is None or end_time is None:
+            return False
+        if start_time <= end_time:
+            return start_time <= now_utc_time <= end_time
+        return now_utc_time >= start_time or now_utc_time <= end_time
+
+# In-process cache of the global config. Invalidated immediately by local updates,
+# by the change stream watcher when available, and otherwise by CONFIG_CACHE_TTL_SECONDS.
+_cached_config: Optional[SystemConfig] = None
+_cached_at: float = 0.0
+_change_stream_active = False
+_load_lock = asyncio.Lock()
+# Bumped by every invalidation, so a load that raced with one is not cached.
+_generation = 0
+# Longest wait between attempts to reopen the change stream.
+_WATCH_MAX_RETRY_SECONDS = 60.0
+
+def _cache_is_fresh() -> bool:
+    if _cached_config is None:
+        return False
+    if _change_stream_active:
+        return True
+    return monotonic() - _cached_at < CONFIG_CACHE_TTL_SECONDS
+
+async def _load_system_config() -> SystemConfig:
     config_doc = await config_collection.find_one({"_id": "global_settings"})
     if config_doc:
         return SystemConfig(**config_doc)
     # If no config exists, return the default one
     return SystemConfig()
 
+def invalidate_system_config_cache():
+    """Drops the cached config so the next read goes back to the database."""
+    global _cached_config, _generation
+    _cached_config = None
+    _generation += 1
+
+async def get_system_config(fresh: bool = False) -> SystemConfig:
+    """Retrieves the global system configuration, served from the in-process cache when possible."""
+    global _cached_config, _cached_at
+    if not fresh and _cache_is_fresh():
+        return _cached_config
+    async with _load_lock:
+        # Another request may have reloaded it while we were waiting for the lock.
+        if not fresh and _cache_is_fresh():
+            return _cached_config
+        generation = _generation
+        config = await _load_system_config()
+        # A document read before a concurrent update or change event may be stale.
+        if generation == _generation:
+            _cached_config = config
+            _cached_at = monotonic()
+        return config
+
 async def update_system_config(config_update: dict):
-    """Updates the global system configuration."""
-    await config_collection.update_one(
+    """Updates the global system configuration and caches the updated document."""
+    global _cached_config, _cached_at
+    config_doc = await config_collection.find_one_and_update(
         {"_id": "global_settings"},
-        {"$set": config_update},
-        upsert=True # Creates the document if it doesn't exist
-    )
\ No newline at end of file
+        {"$set": config_update, "$inc": {"version": 1}},
+        upsert=True, # Creates the document if it doesn't exist
+        return_document=ReturnDocument.AFTER
+    )
+    # Invalidating first keeps loads that read the old document from caching it.
+    invalidate_system_config_cache()
+    _cached_config = SystemConfig(**config_doc)
+    _cached_at = monotonic()
+
+async def watch_system_config():
+    """
+    Invalidates the cache whenever another worker changes the config. Change streams
+    need a replica set; while the stream is down the TTL takes over, and reopening it
+    is retried with exponential backoff.
+    """
+    global _change_stream_active
+    retry_in = 1.0
+    while True:
+        try:
+            async with config_collection.watch() as stream:
+                _change_stream_active = True
+                retry_in = 1.0
+                invalidate_system_config_cache()
+                async for _ in stream:
+                    invalidate_system_config_cache()
+        except PyMongoError as e:
+            logger.warning(
+                "System config change stream unavailable, falling back to TTL polling",
+                extra={"ttl_seconds": CONFIG_CACHE_TTL_SECONDS, "retry_in_seconds": retry_in, "error": str(e)}
+            )
+        finally:
+            _change_stream_active = False
+        await asyncio.sleep(retry_in)
+        retry_in = min(retry_in * 2, _WATCH_MAX_RETRY_SECONDS)
@@ -1,10 +1,54 @@
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
-from .config import MONGO_URI, DATABASE_NAME
+from pymongo.errors import PyMongoError
+from .config import (
+    MONGO_URI, DATABASE_NAME, RESULT_CACHE_TTL_SECONDS, USAGE_EVENTS_TTL_DAYS,
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_SERVER_SELECTION_TIMEOUT_MS,
+)
+from .metrics import MongoCommandMetrics, MongoPoolMetrics
 
-# Create a connection to the MongoDB server
-client = AsyncIOMotorClient(MONGO_URI)
+# Create a connection to the MongoDB server. Motor connects lazily, so each worker
+# process opens its own pool on first use; the app lifespan warms it up and closes it.
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    event_listeners=[MongoCommandMetrics(), MongoPoolMetrics()],
+)
 database = client[DATABASE_NAME]
 user_collection = database.get_collection("users")
+analysis_cache_collection = database.get_collection("analysis_cache")
+admission_collection = database.get_collection("admission_state")
+usage_events_collection = database.get_collection("usage_events")
+usage_rollups_collection = database.get_collection("usage_rollups")
+
+async def ensure_indexes():
+    """Creates the indexes backing credential lookups and cache expiry. Safe to run on every startup."""
+    await user_collection.create_index("access_key", unique=True, name="access_key_unique")
+    await user_collection.create_index([("access_key", 1), ("device_key", 1)], name="access_key_device_key")
+    await user_collection.create_index("username", name="username")
+    await analysis_cache_collection.create_index("created_at", expireAfterSeconds=RESULT_CACHE_TTL_SECONDS, name="created_at_ttl")
+    await admission_collection.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
+    await usage_events_collection.create_index("created_at", expireAfterSeconds=USAGE_EVENTS_TTL_DAYS * 86400, name="created_at_ttl")
+    await usage_events_collection.create_index([("user_id", 1), ("created_at", 1)], name="user_id_created_at")
+    await usage_rollups_collection.create_index(
+        [("scope", 1), ("key", 1), ("granularity", 1), ("bucket", 1)], unique=True, name="rollup_key_unique"
+    )
+    # Serves "every user/model in a bucket" listings, busiest first.
+    await usage_rollups_collection.create_index([("scope", 1), ("granularity", 1), ("bucket", 1), ("calls", -1)], name="scope_bucket_calls")
+    await usage_rollups_collection.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
+
+async def ping_database(timeout: float = 2.0) -> bool:
+    """True if the server answers a ping within `timeout` seconds."""
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout)
+    except (PyMongoError, asyncio.TimeoutError):
+        return False
+    return True
+
+def close_database():
+    client.close()
 
 # Helper to convert MongoDB's _id to a string 'id'
 def user_helper(user) -> dict:
@@ -19,4 +63,23 @@ def user_helper(user) -> dict:
         "expires_on": user.get("expires_on"),
         "txl_config": user.get("txl_config"),
         "ixl_config": user.get("ixl_config"),
-    }
\ No newline at end of file
+        "pipeline_mode": user.get("pipeline_mode", "two_stage"),
+        "rate_limit_per_minute": user.get("rate_limit_per_minute"),
+        "rate_limit_burst": user.get("rate_limit_burst"),
+        "max_concurrent_requests": user.get("max_concurrent_requests"),
+    }
+
+# Fields an admin listing may ask for; "id" is always included.
+USER_FIELDS = (
+    "username", "access_key", "is_active", "api_calls_total", "api_call_limit",
+    "created_at", "expires_on", "txl_config", "ixl_config", "pipeline_mode",
+    "rate_limit_per_minute", "rate_limit_burst", "max_concurrent_requests",
+)
+
+# Like user_helper, but for documents fetched with a projection of `fields`
+def partial_user_helper(user, fields) -> dict:
+    helper = {"id": str(user["_id"]), **{field: user.get(field) for field in fields}}
+    # Same default as user_helper for documents created before pipeline modes existed.
+    if "pipeline_mode" in fields and helper["pipeline_mode"] is None:
+        helper["pipeline_mode"] = "two_stage"
+    return helper
\ No newline at end of file
@@ -0,0 +1,291 @@
+# core/metrics.py
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+# Latency buckets in seconds, from sub-millisecond cache hits up to slow upstream calls.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Pymongo listeners report from Motor's executor threads, hence the lock.
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    le_label = 'le="' + le + '"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le_label)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class RequestTimings:
+    """Wall time, per-stage durations and provider requests of one analysis call, for usage analytics."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.upstream_calls: List[dict] = []
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> RequestTimings:
+    """
+    Starts collecting stage durations for the current task and the tasks it creates.
+    Every request is handled in its own task, so one request never sees another's.
+    """
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    return timings
+
+
+def current_request_timings() -> Optional[RequestTimings]:
+    return _request_timings.get()
+
+
+class StageHistogram(Histogram):
+    """A Histogram labelled by stage that also adds each observation to the current RequestTimings."""
+
+    def observe(self, value: float, **labels):
+        super().observe(value, **labels)
+        timings = _request_timings.get()
+        if timings is not None:
+            stage = labels["stage"]
+            timings.stages[stage] = timings.stages.get(stage, 0.0) + value
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    """Renders every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Shared metrics. Each worker process keeps its own values.
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests handled.", ("method", "route", "status"))
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time until the response finished.", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being handled.")
+
+ANALYZE_STAGE_DURATION = StageHistogram("analyze_stage_duration_seconds", "Time spent in each /analyze stage.", ("stage",))
+ANALYZE_IN_FLIGHT = Gauge("analyze_requests_in_flight", "Analyses currently running.")
+BACKGROUND_FLUSH_DURATION = Histogram("background_flush_duration_seconds", "Time spent writing buffered usage data to Mongo.", ("buffer",))
+
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Requests to IXL/TXL providers by outcome.", ("stage", "base_url", "model_id", "status"))
+UPSTREAM_DURATION = Histogram("upstream_request_duration_seconds", "IXL/TXL provider request latency.", ("stage", "base_url", "model_id"))
+UPSTREAM_IN_FLIGHT = Gauge("upstream_requests_in_flight", "IXL/TXL provider requests currently open.", ("stage",))
+UPSTREAM_EXTRA_ATTEMPTS = Counter("upstream_extra_attempts_total", "Provider attempts beyond the first, by kind (retry, fallback, hedge).", ("stage", "kind"))
+UPSTREAM_CIRCUIT_OPEN = Gauge("upstream_circuit_open", "1 while the circuit breaker of a provider endpoint is open.", ("base_url", "model_id"))
+
+IMAGE_BYTES = Counter("image_preprocess_bytes_total", "Screenshot bytes before and after preprocessing.", ("direction",))
+IMAGE_BYTES_SAVED = Histogram(
+    "image_preprocess_bytes_saved", "Bytes saved per screenshot by preprocessing.",
+    buckets=(0, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000),
+)
+
+ADMISSION_REJECTIONS = Counter("admission_rejections_total", "Analysis requests turned away with 429 by admission control.", ("reason",))
+ADMISSION_WAITING = Gauge("admission_requests_waiting", "Analysis requests queued for a concurrency slot.")
+
+MONGO_COMMAND_DURATION = Histogram("mongo_command_duration_seconds", "MongoDB command latency.", ("command",))
+MONGO_COMMAND_FAILURES = Counter("mongo_command_failures_total", "Failed MongoDB commands.", ("command",))
+MONGO_POOL_CONNECTIONS = Gauge("mongo_pool_connections", "Open connections in this worker's Mongo pools.")
+MONGO_POOL_CHECKED_OUT = Gauge("mongo_pool_checked_out", "Mongo connections currently in use.")
+MONGO_POOL_CHECKOUT_FAILURES = Counter("mongo_pool_checkout_failures_total", "Failed Mongo connection checkouts.", ("reason",))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Pymongo command listener feeding the Mongo latency histogram."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1_000_000, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1_000_000, command=event.command_name)
+        MONGO_COMMAND_FAILURES.inc(command=event.command_name)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Pymongo pool listener tracking open and checked-out connections for readiness and /metrics."""
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.inc(reason=event.reason)
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_CHECKED_OUT.inc()
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.dec()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route request counts, latency and in-flight requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # The router stores the matched route in the scope; unmatched paths share one label.
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=status_code)
+            HTTP_REQUEST_DURATION.observe(perf_counter() - started, method=scope["method"], route=route)
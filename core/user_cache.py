@@ -0,0 +1,64 @@
+# core/user_cache.py
+
+from typing import Iterable, Optional
+
+from .cache import TTLCache
+from .config import USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS
+from .database import user_collection
+
+# Authenticated user documents keyed by access_key. Entries are evicted by the
+# admin mutations and refreshed after USER_CACHE_TTL_SECONDS so changes made on
+# other workers are picked up without a round trip per client poll.
+_user_cache = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+
+
+async def get_user_by_access_key(access_key: str, refresh: bool = False) -> Optional[dict]:
+    """Returns the user document for an access key, from the cache unless `refresh` is set."""
+    if not refresh:
+        user = _user_cache.get(access_key)
+        if user is not None:
+            return user
+    user = await user_collection.find_one({"access_key": access_key})
+    if user is not None:
+        _user_cache.set(access_key, user)
+    else:
+        _user_cache.pop(access_key)
+    return user
+
+
+async def get_user_for_device(access_key: str, device_key: str) -> Optional[dict]:
+    """
+    Returns the user document if `device_key` is the device currently bound to it.
+    A cached copy with another device key or an inactive flag is re-read from Mongo
+    before the request is rejected: /auth/activate and the admin endpoints only evict
+    the cache of the worker that served them.
+    """
+    user = await get_user_by_access_key(access_key)
+    if user is not None and (not user.get("is_active") or user.get("device_key") != device_key):
+        user = await get_user_by_access_key(access_key, refresh=True)
+    if not user or user.get("device_key") != device_key:
+        return None
+    return user
+
+
+def update_cached_user(access_key: str, changes: dict):
+    """Mirrors a `$set` that was just written to Mongo onto the cached copy, if any."""
+    user = _user_cache.get(access_key)
+    if user is not None:
+        user.update(changes)
+
+
+def evict_user(user_id=None, access_key: Optional[str] = None):
+    """Drops a user from the cache by access key or by document id."""
+    if access_key is not None:
+        _user_cache.pop(access_key)
+    if user_id is not None:
+        evict_users([user_id])
+
+
+def evict_users(user_ids: Iterable):
+    """Drops every cached entry belonging to the given user ids in a single pass."""
+    user_ids = set(user_ids)
+    for key, user in _user_cache.items():
+        if user["_id"] in user_ids:
+            _user_cache.pop(key)
@@ -1,15 +1,123 @@
+import asyncio
+import signal
+import threading
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from pymongo.errors import PyMongoError
+
+from api import admin, analysis, client_events, monitoring
+from core.config import WEB_CONCURRENCY, SHUTDOWN_PRESTOP_SECONDS, SHUTDOWN_DRAIN_SECONDS, SERVER_KEEPALIVE_SECONDS, SERVER_BACKLOG
+from core.database import ensure_indexes, ping_database, close_database, user_collection
+from core.log import get_logger
+from core.metrics import MetricsMiddleware
+from core.config_manager import get_system_config, watch_system_config
+from services.analysis_pipeline import drain_in_flight
+from services.http_client import close_http_clients, warm_up_http_clients
+from services.image_processing import start_image_pool, warm_up_image_pool, shutdown_image_pool
+from services.usage import usage_tracker
+from services.analytics import usage_analytics
+from services.events import watch_user_changes
+
+
+logger = get_logger("main")
+
+
+async def _upstream_base_urls() -> list:
+    """Every IXL/TXL endpoint, including fallbacks, configured for an active user."""
+    base_urls = []
+    for stage in ("ixl_config", "txl_config"):
+        for field in (f"{stage}.base_url", f"{stage}.fallbacks.base_url"):
+            base_urls.extend(await user_collection.distinct(field, {"is_active": True}))
+    return base_urls
+
+
+async def _warm_up():
+    """Gets the worker's pools ready before uvicorn starts handing it requests."""
+    if not await ping_database(timeout=10):
+        logger.warning("MongoDB did not answer the warmup ping")
+    try:
+        await ensure_indexes()
+    except PyMongoError as e:
+        logger.warning("Could not create indexes", extra={"error": str(e)})
+    try:
+        await get_system_config()
+    except PyMongoError as e:
+        logger.warning("Could not load the system config", extra={"error": str(e)})
+    start_image_pool()
+    try:
+        base_urls = await _upstream_base_urls()
+    except PyMongoError as e:
+        logger.warning("Could not list upstreams to pre-connect", extra={"error": str(e)})
+        base_urls = []
+    await asyncio.gather(warm_up_http_clients(base_urls), warm_up_image_pool())
+
+
+def _install_prestop(app: FastAPI):
+    """
+    Makes /ready fail as soon as SIGTERM arrives and passes the signal on to uvicorn
+    only SHUTDOWN_PRESTOP_SECONDS later, so load balancers stop routing to this worker
+    while it still serves what they send in the meantime. A second SIGTERM skips the
+    wait. Returns a function that puts uvicorn's own handler back.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    # Only wrap a Python-level handler (uvicorn's), and signals can only be set from the main thread.
+    if SHUTDOWN_PRESTOP_SECONDS <= 0 or not callable(previous) or threading.current_thread() is not threading.main_thread():
+        return lambda: None
+    loop = asyncio.get_running_loop()
+
+    def begin_draining(sig):
+        logger.info("SIGTERM received, draining before shutdown", extra={"prestop_seconds": SHUTDOWN_PRESTOP_SECONDS})
+        loop.call_later(SHUTDOWN_PRESTOP_SECONDS, previous, sig, None)
+
+    def handle_sigterm(sig, frame):
+        if app.state.serving == "draining":
+            previous(sig, frame)
+            return
+        app.state.serving = "draining"
+        loop.call_soon_threadsafe(begin_draining, sig)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    return lambda: signal.signal(signal.SIGTERM, previous)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Owns the shared resources that live for the whole process."""
+    app.state.serving = "starting"
+    await _warm_up()
+    config_watcher = asyncio.create_task(watch_system_config())
+    user_watcher = asyncio.create_task(watch_user_changes())
+    usage_tracker.start()
+    usage_analytics.start()
+    app.state.serving = "ready"
+    restore_sigterm = _install_prestop(app)
+    logger.info("Worker ready")
+    yield
+    # Uvicorn has already stopped accepting connections and waited for open requests;
+    # upstream runs shared between requests may still be finishing.
+    app.state.serving = "draining"
+    restore_sigterm()
+    config_watcher.cancel()
+    user_watcher.cancel()
+    await drain_in_flight(SHUTDOWN_DRAIN_SECONDS)
+    await usage_tracker.stop()
+    await usage_analytics.stop()
+    await close_http_clients()
+    shutdown_image_pool()
+    close_database()
+    logger.info("Worker stopped")
 
-from api import admin, analysis
 
 app = FastAPI(
     title="Buckminster Fullerene Backend",
     description="The central server for managing users and analyzing screen captures.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -19,7 +127,9 @@ app.add_middleware(
 )
 
 app.include_router(analysis.router, tags=["Client"])
+app.include_router(client_events.router, tags=["Client"])
 app.include_router(admin.router, tags=["Admin"])
+app.include_router(monitoring.router, tags=["Monitoring"])
 
 
 @app.get("/", tags=["Root"])
@@ -31,4 +141,14 @@ async def read_root():
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+    # Each worker is a separate process with its own pools, caches and metrics.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=False,
+        workers=WEB_CONCURRENCY,
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS,
+    )
@@ -1,15 +1,31 @@
 # models/user.py
 
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Literal, Optional
 from datetime import datetime
 import uuid
 
-class LLMConfig(BaseModel):
+class LLMEndpoint(BaseModel):
     api_key: Optional[str] = None
     base_url: Optional[str] = None
     model_id: Optional[str] = None
 
+class LLMConfig(LLMEndpoint):
+    # Tried in order when the primary endpoint fails or its circuit breaker is open.
+    fallbacks: List[LLMEndpoint] = Field(default_factory=list)
+    # Send a duplicate request to the next endpoint if the first has not answered
+    # within this many seconds. Overrides UPSTREAM_HEDGE_AFTER_SECONDS; 0 disables it.
+    hedge_after_seconds: Optional[float] = None
+
+    def endpoints(self) -> List[LLMEndpoint]:
+        """The primary endpoint followed by the complete fallbacks, in configured order."""
+        primary = LLMEndpoint(api_key=self.api_key, base_url=self.base_url, model_id=self.model_id)
+        return [primary] + [f for f in self.fallbacks if f.api_key and f.base_url and f.model_id]
+
+# "two_stage": IXL describes the image, TXL answers from the description.
+# "fused": the image goes straight to the TXL model, which must accept image input.
+PipelineMode = Literal["two_stage", "fused"]
+
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), alias="_id")
     username: str
@@ -24,6 +40,12 @@ class User(BaseModel):
     
     txl_config: LLMConfig = Field(default_factory=LLMConfig)
     ixl_config: LLMConfig = Field(default_factory=LLMConfig)
+    pipeline_mode: PipelineMode = "two_stage"
+
+    # Per-user admission limits; None falls back to the SystemConfig defaults.
+    rate_limit_per_minute: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
+    max_concurrent_requests: Optional[int] = None
 
 class UserUpdate(BaseModel):
     username: Optional[str] = None
@@ -31,4 +53,8 @@ class UserUpdate(BaseModel):
     api_call_limit: Optional[int] = None
     expires_on: Optional[datetime] = None
     txl_config: Optional[LLMConfig] = None
-    ixl_config: Optional[LLMConfig] = None
\ No newline at end of file
+    ixl_config: Optional[LLMConfig] = None
+    pipeline_mode: Optional[PipelineMode] = None
+    rate_limit_per_minute: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
+    max_concurrent_requests: Optional[int] = None
\ No newline at end of file
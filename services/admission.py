@@ -0,0 +1,253 @@
+# services/admission.py
+
+import asyncio
+import math
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from core.cache import TTLCache
+from core.config import (
+    ADMISSION_BACKEND,
+    ADMISSION_LEASE_SECONDS,
+    ADMISSION_POLL_SECONDS,
+    ADMISSION_RETRY_AFTER_SECONDS,
+    USER_CACHE_MAX_ENTRIES,
+)
+from core.config_manager import SystemConfig
+from core.database import admission_collection
+from core.log import get_logger
+from core.metrics import ADMISSION_REJECTIONS, ADMISSION_WAITING
+
+logger = get_logger("admission")
+
+# A full bucket refills in at most an hour, so idle buckets can be dropped after that.
+_BUCKET_IDLE_SECONDS = 3600
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class MemoryAdmissionBackend:
+    """Token buckets and in-flight counters of this worker only."""
+
+    # Slots are freed on this worker and waiters are woken directly; the poll only
+    # covers a release landing between a failed attempt and the wait.
+    poll_interval = 0.25
+
+    def __init__(self):
+        self._buckets = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=_BUCKET_IDLE_SECONDS)
+        self._in_flight: Dict[str, int] = defaultdict(int)
+
+    async def take_tokens(self, key: str, rate: float, burst: int, cost: int) -> float:
+        """Takes `cost` tokens from the bucket; returns 0 on success, otherwise seconds until they are available."""
+        now = monotonic()
+        tokens, updated_at = self._buckets.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0.0
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets.set(key, (tokens, now))
+        return wait
+
+    async def acquire_slot(self, key: str, limit: int) -> Optional[str]:
+        """Returns a lease for one of `limit` slots, or None when all are taken."""
+        if self._in_flight[key] >= limit:
+            return None
+        self._in_flight[key] += 1
+        return key
+
+    async def release_slot(self, key: str, lease: str):
+        self._in_flight[key] -= 1
+        if self._in_flight[key] <= 0:
+            del self._in_flight[key]
+
+
+class MongoAdmissionBackend:
+    """
+    Shares token buckets and concurrency slots between workers through the
+    admission_state collection. Slots are leases that expire after
+    ADMISSION_LEASE_SECONDS. If Mongo is unreachable, requests are admitted
+    rather than failed.
+    """
+
+    poll_interval = ADMISSION_POLL_SECONDS
+
+    async def take_tokens(self, key: str, rate: float, burst: int, cost: int) -> float:
+        now = datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        try:
+            # Refill and take in one atomic pipeline update, so concurrent workers cannot both spend the last token.
+            bucket = await admission_collection.find_one_and_update(
+                {"_id": f"bucket:{key}"},
+                [
+                    {"$set": {
+                        "tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [rate, elapsed]}]}]},
+                        "updated_at": now,
+                        "expires_at": now + timedelta(seconds=_BUCKET_IDLE_SECONDS),
+                    }},
+                    {"$set": {"granted": {"$gte": ["$tokens", cost]}}},
+                    {"$set": {"tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", cost]}, "$tokens"]}}},
+                ],
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except PyMongoError as e:
+            logger.warning("Shared rate limit unavailable, admitting request", extra={"error": str(e)})
+            return 0.0
+        return 0.0 if bucket["granted"] else (cost - bucket["tokens"]) / rate
+
+    async def acquire_slot(self, key: str, limit: int) -> Optional[str]:
+        now = datetime.utcnow()
+        lease = uuid.uuid4().hex
+        try:
+            # Drop leases left behind by crashed workers, then take a slot only if fewer than `limit` remain.
+            await admission_collection.update_one(
+                {"_id": f"slots:{key}"},
+                {"$pull": {"leases": {"expires_at": {"$lt": now}}},
+                 "$set": {"expires_at": now + timedelta(seconds=ADMISSION_LEASE_SECONDS)}},
+                upsert=True,
+            )
+            result = await admission_collection.update_one(
+                {"_id": f"slots:{key}", f"leases.{limit - 1}": {"$exists": False}},
+                {"$push": {"leases": {"id": lease, "expires_at": now + timedelta(seconds=ADMISSION_LEASE_SECONDS)}}},
+            )
+        except PyMongoError as e:
+            logger.warning("Shared concurrency slots unavailable, admitting request", extra={"error": str(e)})
+            return ""
+        return lease if result.modified_count else None
+
+    async def release_slot(self, key: str, lease: str):
+        if not lease:
+            return
+        try:
+            await admission_collection.update_one({"_id": f"slots:{key}"}, {"$pull": {"leases": {"id": lease}}})
+        except PyMongoError as e:
+            logger.warning("Could not release shared concurrency slot; it expires with its lease", extra={"error": str(e)})
+
+
+def _limits(user: Optional[dict], config: SystemConfig) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+    """Per-minute rate, burst and per-user concurrency for a user, falling back to the global defaults."""
+    user = user or {}
+    rate = user.get("rate_limit_per_minute") or config.rate_limit_per_minute
+    # Without an explicit burst, a client may spend one minute's allowance at once.
+    burst = user.get("rate_limit_burst") or config.rate_limit_burst or (max(1, math.ceil(rate)) if rate else None)
+    concurrency = user.get("max_concurrent_requests") or config.max_concurrent_per_user
+    return rate, burst, concurrency
+
+
+def _slot_scopes(user: Optional[dict], config: SystemConfig, user_concurrency: Optional[int]) -> List[Tuple[str, int]]:
+    """The concurrency caps a request takes one slot of, as (key, limit) pairs."""
+    slots = []
+    if config.max_concurrent_global:
+        slots.append(("global", config.max_concurrent_global))
+    if user and user_concurrency:
+        slots.append((f"user:{user['_id']}", user_concurrency))
+    return slots
+
+
+class AdmissionController:
+    """
+    Per-user token-bucket rate limits plus per-user and global caps on requests
+    in flight. A request that finds no free slot waits in a bounded per-worker
+    queue; when the queue is full or the wait times out it is rejected, so
+    overload turns into fast 429s instead of piling up on the upstreams.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._waiting = 0
+        self._released = asyncio.Condition()
+
+    async def admit(self, user: Optional[dict], config: SystemConfig, cost: int = 1) -> List[Tuple[str, str]]:
+        """Returns the held slots, to be passed to release() once the request is done."""
+        rate, burst, user_concurrency = _limits(user, config)
+        if user and rate:
+            # A batch larger than the burst could never be admitted; it takes the whole bucket instead.
+            cost = min(cost, burst)
+            wait = await self.backend.take_tokens(f"user:{user['_id']}", rate / 60, burst, cost)
+            if wait:
+                raise self._reject("rate_limited", "Too many requests for this key. Please slow down.", wait)
+
+        slots = _slot_scopes(user, config, user_concurrency)
+        held = await self._try_acquire(slots)
+        if held is not None:
+            return held
+        if self._waiting >= config.admission_queue_size:
+            raise self._reject("busy", "Too many requests in progress. Please try again shortly.", ADMISSION_RETRY_AFTER_SECONDS)
+
+        self._waiting += 1
+        ADMISSION_WAITING.inc()
+        try:
+            deadline = monotonic() + config.admission_queue_timeout_seconds
+            while held is None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise self._reject("queue_timeout", "Too many requests in progress. Please try again shortly.", ADMISSION_RETRY_AFTER_SECONDS)
+                async with self._released:
+                    try:
+                        await asyncio.wait_for(self._released.wait(), min(remaining, self.backend.poll_interval))
+                    except asyncio.TimeoutError:
+                        pass
+                held = await self._try_acquire(slots)
+            return held
+        finally:
+            self._waiting -= 1
+            ADMISSION_WAITING.dec()
+
+    async def acquire_more(self, user: Optional[dict], config: SystemConfig, count: int) -> Tuple[List[Tuple[str, str]], int]:
+        """
+        Takes up to `count` further slots for an admitted request that runs several
+        calls at once, without waiting for any. Returns the held slots, to be released
+        with the rest, and how many were taken; all of them when nothing is capped.
+        """
+        slots = _slot_scopes(user, config, _limits(user, config)[2])
+        if not slots:
+            return [], count
+        held = []
+        taken = 0
+        while taken < count:
+            extra = await self._try_acquire(slots)
+            if extra is None:
+                break
+            held.extend(extra)
+            taken += 1
+        return held, taken
+
+    async def release(self, held: List[Tuple[str, str]]):
+        for key, lease in held:
+            await self.backend.release_slot(key, lease)
+        if held:
+            async with self._released:
+                self._released.notify_all()
+
+    async def _try_acquire(self, slots: List[Tuple[str, int]]) -> Optional[List[Tuple[str, str]]]:
+        held = []
+        for key, limit in slots:
+            lease = await self.backend.acquire_slot(key, limit)
+            if lease is None:
+                for held_key, held_lease in held:
+                    await self.backend.release_slot(held_key, held_lease)
+                return None
+            held.append((key, lease))
+        return held
+
+    @staticmethod
+    def _reject(reason: str, detail: str, retry_after: float) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        return AdmissionRejected(reason, detail, retry_after)
+
+
+admission_controller = AdmissionController(MongoAdmissionBackend() if ADMISSION_BACKEND == "mongo" else MemoryAdmissionBackend())
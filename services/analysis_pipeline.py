@@ -0,0 +1,205 @@
+# services/analysis_pipeline.py
+
+import asyncio
+import base64
+import binascii
+import re
+from collections import defaultdict
+from time import perf_counter
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from core.metrics import ANALYZE_STAGE_DURATION
+from models.user import LLMConfig
+from services.llm_service import (
+    get_image_description_from_ixl,
+    get_final_answer_from_txl,
+    get_final_answer_from_image,
+    stream_final_answer_from_txl,
+    stream_final_answer_from_image,
+)
+from services.image_processing import prepare_image
+from services.result_cache import result_cache_key, get_cached_result, store_result
+
+# Upstream work currently running, by result cache key. Identical concurrent
+# submissions await the same task instead of starting their own.
+_in_flight: Dict[str, asyncio.Task] = {}
+
+
+# The TXL prompt makes the model open its answer with one of these tags.
+_CLASSIFIER_PATTERN = re.compile(r"\[(OPTION:[A-E]|CODE)\]")
+# Longest prefix worth holding back while waiting for the tag to complete.
+_CLASSIFIER_MAX_PREFIX = 16
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+class PipelineStats:
+    """Running totals per pipeline mode, so fused and two-stage runs can be compared on latency and tokens."""
+
+    def __init__(self):
+        self._totals = defaultdict(lambda: {"runs": 0, "errors": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+
+    def record(self, mode: str, seconds: float, usage: dict, ok: bool):
+        totals = self._totals[mode]
+        totals["runs"] += 1
+        totals["errors"] += 0 if ok else 1
+        totals["seconds"] += seconds
+        totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        totals["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    def snapshot(self) -> dict:
+        report = {}
+        for mode, totals in self._totals.items():
+            runs = totals["runs"] or 1
+            report[mode] = {
+                "runs": totals["runs"],
+                "errors": totals["errors"],
+                "avg_latency_ms": round(totals["seconds"] * 1000 / runs, 1),
+                "avg_prompt_tokens": round(totals["prompt_tokens"] / runs, 1),
+                "avg_completion_tokens": round(totals["completion_tokens"] / runs, 1),
+            }
+        return report
+
+
+# Upstream runs only; cache hits are excluded so they do not flatter either mode.
+# Streaming runs are tracked under "<mode>_stream" since providers do not report their tokens.
+pipeline_stats = PipelineStats()
+
+
+async def drain_in_flight(timeout: float):
+    """Waits for shielded upstream runs that outlived their requests, e.g. before shutdown."""
+    if _in_flight:
+        await asyncio.wait(list(_in_flight.values()), timeout=timeout)
+
+
+def _parse_classifier(text: str) -> Tuple[bool, Optional[str]]:
+    """Returns (decided, tag) for the start of an answer. Undecided means more text is needed."""
+    head = text.lstrip()
+    match = _CLASSIFIER_PATTERN.match(head)
+    if match:
+        return True, match.group(1)
+    if not head:
+        return False, None
+    if not head.startswith("[") or "]" in head or len(head) >= _CLASSIFIER_MAX_PREFIX:
+        return True, None
+    return False, None
+
+
+def decode_image_data(image_base64: str) -> bytes:
+    """Decodes the base64 image_data of a JSON /analyze request, optionally given as a data: URL."""
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.partition(",")[2]
+    try:
+        # Strict, so stray characters are rejected rather than silently dropped.
+        image_bytes = base64.b64decode(image_base64.strip(), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImageError(f"Image data is not valid base64. {e}")
+    if not image_bytes:
+        raise InvalidImageError("Image data is empty.")
+    return image_bytes
+
+
+async def _run_upstream(key: str, image_bytes: bytes, ixl_config: LLMConfig, txl_config: LLMConfig, pipeline_mode: str) -> str:
+    # Cache keys use the image as uploaded; only the copy sent upstream is normalized.
+    upstream_image, mime_type = await prepare_image(image_bytes)
+    started = perf_counter()
+    usage = {}
+    try:
+        if pipeline_mode == "fused":
+            image_description = None
+            with ANALYZE_STAGE_DURATION.time(stage="fused"):
+                final_answer = await get_final_answer_from_image(upstream_image, txl_config, usage, mime_type)
+        else:
+            with ANALYZE_STAGE_DURATION.time(stage="ixl"):
+                image_description = await get_image_description_from_ixl(upstream_image, ixl_config, usage, mime_type)
+            with ANALYZE_STAGE_DURATION.time(stage="txl"):
+                final_answer = await get_final_answer_from_txl(image_description, txl_config, usage)
+    except Exception:
+        pipeline_stats.record(pipeline_mode, perf_counter() - started, usage, ok=False)
+        raise
+    pipeline_stats.record(pipeline_mode, perf_counter() - started, usage, ok=True)
+    await store_result(key, image_description, final_answer)
+    return final_answer
+
+
+async def analyze_image(image_bytes: bytes, ixl_config: LLMConfig, txl_config: LLMConfig, pipeline_mode: str = "two_stage") -> str:
+    """
+    Runs the configured pipeline for a screenshot, reusing the cached answer for an
+    identical image and endpoint configuration and coalescing concurrent duplicates.
+    """
+    key = result_cache_key(image_bytes, ixl_config, txl_config, pipeline_mode)
+    with ANALYZE_STAGE_DURATION.time(stage="result_cache"):
+        cached = await get_cached_result(key)
+    if cached is not None:
+        return cached["answer"]
+
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(_run_upstream(key, image_bytes, ixl_config, txl_config, pipeline_mode))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # Shielded so one disconnecting client does not cancel the call for everyone waiting on it.
+    return await asyncio.shield(task)
+
+
+async def stream_analysis(image_bytes: bytes, ixl_config: LLMConfig, txl_config: LLMConfig, pipeline_mode: str = "two_stage") -> AsyncIterator[Tuple[str, dict]]:
+    """
+    Streaming variant of analyze_image. Yields ("classifier", {"tag"}) as soon as the
+    answer's tag has been parsed, ("token", {"text"}) as TXL produces text, and finally
+    ("done", {"result"}) with the same full answer /analyze would have returned.
+    """
+    key = result_cache_key(image_bytes, ixl_config, txl_config, pipeline_mode)
+    cached = await get_cached_result(key)
+    if cached is None and key in _in_flight:
+        cached = {"answer": await asyncio.shield(_in_flight[key])}
+    if cached is not None:
+        answer = cached["answer"]
+        _, tag = _parse_classifier(answer)
+        if tag:
+            yield "classifier", {"tag": tag}
+        yield "token", {"text": answer}
+        yield "done", {"result": answer}
+        return
+
+    upstream_image, mime_type = await prepare_image(image_bytes)
+    started = perf_counter()
+    stats_mode = f"{pipeline_mode}_stream"
+    if pipeline_mode == "fused":
+        image_description = None
+        answer_stream = stream_final_answer_from_image(upstream_image, txl_config, mime_type)
+    else:
+        try:
+            image_description = await get_image_description_from_ixl(upstream_image, ixl_config, mime_type=mime_type)
+        except Exception:
+            pipeline_stats.record(stats_mode, perf_counter() - started, {}, ok=False)
+            raise
+        answer_stream = stream_final_answer_from_txl(image_description, txl_config)
+
+    parts = []
+    held = ""
+    decided = False
+    try:
+        async for text in answer_stream:
+            parts.append(text)
+            if decided:
+                yield "token", {"text": text}
+                continue
+            # Hold the first few characters back until the classifier tag is known.
+            held += text
+            decided, tag = _parse_classifier(held)
+            if decided:
+                if tag:
+                    yield "classifier", {"tag": tag}
+                yield "token", {"text": held}
+    except Exception:
+        pipeline_stats.record(stats_mode, perf_counter() - started, {}, ok=False)
+        raise
+    pipeline_stats.record(stats_mode, perf_counter() - started, {}, ok=True)
+    if not decided and held:
+        yield "token", {"text": held}
+
+    final_answer = "".join(parts).strip()
+    await store_result(key, image_description, final_answer)
+    yield "done", {"result": final_answer}
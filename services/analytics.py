@@ -0,0 +1,202 @@
+# services/analytics.py
+
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from core.config import ANALYTICS_FLUSH_INTERVAL_SECONDS, ANALYTICS_MAX_BUFFERED_EVENTS, USAGE_HOURLY_ROLLUP_TTL_DAYS
+from core.database import usage_events_collection, usage_rollups_collection
+from core.log import get_logger
+from core.metrics import BACKGROUND_FLUSH_DURATION, RequestTimings, current_request_timings
+from services.flusher import PeriodicFlusher
+
+logger = get_logger("analytics")
+
+GRANULARITIES = ("hour", "day")
+# Range an admin query covers when it gives no start, and the widest range it may ask for.
+DEFAULT_RANGES = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+MAX_RANGES = {"hour": timedelta(days=31), "day": timedelta(days=366)}
+
+# Call outcomes that count as errors in the per-user rollups.
+_ERROR_OUTCOMES = ("upstream_error", "error")
+
+# (scope, key, granularity, bucket), e.g. ("model", "gpt-4o", "hour", 2024-05-01 13:00)
+RollupKey = Tuple[str, str, str, datetime]
+
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _is_upstream_error(status: str) -> bool:
+    """HTTP error codes and transport failures; hedges that lost their race are not errors."""
+    return status != "cancelled" and not status.startswith("2")
+
+
+def _new_counters() -> Dict[RollupKey, Dict[str, float]]:
+    return defaultdict(lambda: defaultdict(int))
+
+
+class UsageAnalytics(PeriodicFlusher):
+    """
+    Per-call usage events plus pre-aggregated rollups for the admin dashboards.
+
+    Every analysis call becomes one raw event in usage_events, which expires after
+    USAGE_EVENTS_TTL_DAYS, and is folded into per-user rollup documents in usage_rollups,
+    per hour and per day. Per-model rollups are fed by the provider requests themselves,
+    one per endpoint attempt, so fallbacks, retries and hedges are credited to the model
+    that served them and cached answers to none. Everything is buffered and written once
+    per flush interval, the rollups as upserted `$inc` counters, so dashboards read a
+    fixed number of documents per bucket however much traffic there was.
+    """
+
+    def __init__(self, flush_interval: float):
+        super().__init__(flush_interval)
+        self._events = deque(maxlen=ANALYTICS_MAX_BUFFERED_EVENTS)
+        self._dropped = 0
+        self._counters = _new_counters()
+        self._max_latency: Dict[RollupKey, float] = {}
+
+    def record(self, user: dict, endpoint: str, outcome: str, timings: Optional[RequestTimings] = None):
+        """Buffers one call. `timings` defaults to those started for the current request."""
+        timings = timings or current_request_timings()
+        now = datetime.utcnow()
+        latency_ms = round(timings.elapsed() * 1000, 1) if timings else None
+        stages_ms = {stage: round(seconds * 1000, 1) for stage, seconds in timings.stages.items()} if timings else {}
+
+        if len(self._events) == self._events.maxlen:
+            # Mongo has been unreachable for a while; the oldest events give way.
+            self._dropped += 1
+        self._events.append({
+            "user_id": user["_id"],
+            "endpoint": endpoint,
+            "outcome": outcome,
+            "latency_ms": latency_ms,
+            "stages_ms": stages_ms,
+            "pipeline_mode": user.get("pipeline_mode", "two_stage"),
+            # Empty when the answer came from the result cache or a concurrent identical call.
+            "upstream": list(timings.upstream_calls) if timings else [],
+            "created_at": now,
+        })
+        self._add("user", user["_id"], now, outcome, outcome in _ERROR_OUTCOMES, latency_ms, stages_ms)
+
+    def record_upstream(self, stage: str, model_id: Optional[str], status: str, seconds: float):
+        """Buffers one provider request; `status` is the HTTP code, a transport error name or "cancelled"."""
+        latency_ms = round(seconds * 1000, 1)
+        timings = current_request_timings()
+        if timings is not None:
+            timings.upstream_calls.append({"stage": stage, "model_id": model_id, "status": status, "latency_ms": latency_ms})
+        if model_id:
+            self._add("model", model_id, datetime.utcnow(), status, _is_upstream_error(status), latency_ms, {stage: latency_ms})
+
+    def _add(self, scope: str, key: str, now: datetime, outcome: str, failed: bool, latency_ms: Optional[float], stages_ms: Dict[str, float]):
+        for granularity in GRANULARITIES:
+            rollup_key = (scope, key, granularity, bucket_start(now, granularity))
+            counters = self._counters[rollup_key]
+            counters["calls"] += 1
+            counters[f"outcomes.{outcome}"] += 1
+            if failed:
+                counters["errors"] += 1
+            if latency_ms is not None:
+                counters["latency_ms_total"] += latency_ms
+                self._max_latency[rollup_key] = max(latency_ms, self._max_latency.get(rollup_key, 0.0))
+            for stage, ms in stages_ms.items():
+                counters[f"stages.{stage}.ms"] += ms
+                counters[f"stages.{stage}.count"] += 1
+
+    def _restore(self, keys: List[RollupKey], counters, max_latency):
+        """Puts increments that did not reach Mongo back into the buffer for the next flush."""
+        for rollup_key in keys:
+            for field, amount in counters[rollup_key].items():
+                self._counters[rollup_key][field] += amount
+            if rollup_key in max_latency:
+                self._max_latency[rollup_key] = max(max_latency[rollup_key], self._max_latency.get(rollup_key, 0.0))
+
+    async def _write_events(self, events: List[dict]):
+        if self._dropped:
+            logger.warning("Usage events dropped while Mongo was unavailable", extra={"dropped": self._dropped})
+            self._dropped = 0
+        if not events:
+            return
+        try:
+            await usage_events_collection.insert_many(events, ordered=False)
+        except PyMongoError as e:
+            # Raw events are for drill-down only; the rollups are retried and carry the numbers.
+            logger.warning("Could not write usage events", extra={"events": len(events), "error": str(e)})
+
+    async def _write_rollups(self, counters, max_latency):
+        keys = list(counters)
+        if not keys:
+            return
+        operations = []
+        for rollup_key in keys:
+            scope, key, granularity, bucket = rollup_key
+            update = {"$inc": dict(counters[rollup_key])}
+            if rollup_key in max_latency:
+                update["$max"] = {"latency_ms_max": max_latency[rollup_key]}
+            if granularity == "hour":
+                update["$setOnInsert"] = {"expires_at": bucket + timedelta(days=USAGE_HOURLY_ROLLUP_TTL_DAYS)}
+            operations.append(UpdateOne({"scope": scope, "key": key, "granularity": granularity, "bucket": bucket}, update, upsert=True))
+        try:
+            await usage_rollups_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = [keys[error["index"]] for error in e.details.get("writeErrors", [])]
+            logger.error("Usage rollup flush partially failed, will retry", extra={"failed_rollups": len(failed), "error": str(e)})
+            self._restore(failed, counters, max_latency)
+        except PyMongoError as e:
+            logger.error("Usage rollup flush failed, will retry", extra={"error": str(e)})
+            self._restore(keys, counters, max_latency)
+
+    async def flush(self):
+        """Inserts the buffered events and applies the rollup increments, one unordered bulk write each."""
+        async with self._flush_lock:
+            events = list(self._events)
+            self._events.clear()
+            counters, self._counters = self._counters, _new_counters()
+            max_latency, self._max_latency = self._max_latency, {}
+            if not events and not counters and not self._dropped:
+                return
+            with BACKGROUND_FLUSH_DURATION.time(buffer="usage_analytics"):
+                await self._write_events(events)
+                await self._write_rollups(counters, max_latency)
+
+
+def rollup_helper(rollup: dict) -> dict:
+    """A rollup document with averages and the error rate worked out."""
+    calls = rollup.get("calls", 0)
+    errors = rollup.get("errors", 0)
+    return {
+        "bucket": rollup["bucket"],
+        "calls": calls,
+        "errors": errors,
+        "error_rate": round(errors / calls, 4) if calls else 0.0,
+        "outcomes": rollup.get("outcomes", {}),
+        "avg_latency_ms": round(rollup.get("latency_ms_total", 0) / calls, 1) if calls else None,
+        "max_latency_ms": rollup.get("latency_ms_max"),
+        "avg_stage_ms": {
+            stage: round(totals["ms"] / totals["count"], 1)
+            for stage, totals in rollup.get("stages", {}).items() if totals.get("count")
+        },
+    }
+
+
+async def get_rollups(scope: str, granularity: str, start: datetime, end: datetime, key: Optional[str] = None) -> List[dict]:
+    """Rollup documents of one scope with buckets in [start, end], oldest first."""
+    query = {"scope": scope, "granularity": granularity, "bucket": {"$gte": start, "$lte": end}}
+    if key is not None:
+        query["key"] = key
+    return await usage_rollups_collection.find(query).sort([("bucket", 1), ("calls", -1)]).to_list(None)
+
+
+async def get_top_rollups(scope: str, granularity: str, bucket: datetime, limit: int) -> List[dict]:
+    """The busiest keys of a scope in one bucket."""
+    query = {"scope": scope, "granularity": granularity, "bucket": bucket_start(bucket, granularity)}
+    return await usage_rollups_collection.find(query).sort("calls", -1).limit(limit).to_list(None)
+
+
+usage_analytics = UsageAnalytics(flush_interval=ANALYTICS_FLUSH_INTERVAL_SECONDS)
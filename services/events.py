@@ -0,0 +1,91 @@
+# services/events.py
+
+import asyncio
+from collections import defaultdict
+from typing import Dict, Set
+
+from pymongo.errors import PyMongoError
+
+from core.database import user_collection
+from core.log import get_logger
+from core.user_cache import evict_user
+
+logger = get_logger("events")
+
+# Fields whose changes a connected device has to hear about.
+_WATCHED_FIELDS = ("pending_notification", "is_active", "uninstall_pending", "device_key")
+_WATCH_MAX_RETRY_SECONDS = 60.0
+
+
+class EventHub:
+    """
+    In-process pub/sub between the admin endpoints and connected client devices.
+
+    Events are wake-up signals rather than payloads: a woken connection re-reads
+    the user's state and pushes whatever changed, so duplicate or coalesced
+    signals (local admin call plus change stream) are harmless.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Event]] = defaultdict(set)
+
+    def subscribe(self, user_id: str) -> asyncio.Event:
+        wakeup = asyncio.Event()
+        self._subscribers[user_id].add(wakeup)
+        return wakeup
+
+    def unsubscribe(self, user_id: str, wakeup: asyncio.Event):
+        subscribers = self._subscribers.get(user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(wakeup)
+        if not subscribers:
+            del self._subscribers[user_id]
+
+    def notify_user(self, user_id: str):
+        for wakeup in self._subscribers.get(user_id, ()):
+            wakeup.set()
+
+    def notify_all(self):
+        for subscribers in self._subscribers.values():
+            for wakeup in subscribers:
+                wakeup.set()
+
+    def connection_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+event_hub = EventHub()
+
+
+async def watch_user_changes():
+    """
+    Relays user changes made on other workers: evicts the cached user and wakes
+    its connections. Needs a replica set; while the stream is down, connections
+    fall back to re-checking every EVENT_RECHECK_SECONDS, and reopening it is
+    retried with exponential backoff.
+    """
+    pipeline = [{"$match": {"$or": [
+        {"operationType": {"$in": ["replace", "delete"]}},
+        *[{f"updateDescription.updatedFields.{field}": {"$exists": True}} for field in _WATCHED_FIELDS],
+    ]}}]
+    retry_in = None
+    while True:
+        try:
+            async with user_collection.watch(pipeline) as stream:
+                if retry_in is not None:
+                    # Changes made while the stream was down were missed; have every connection re-check.
+                    event_hub.notify_all()
+                retry_in = 1.0
+                async for change in stream:
+                    user_id = change["documentKey"]["_id"]
+                    evict_user(user_id=user_id)
+                    event_hub.notify_user(str(user_id))
+        except PyMongoError as e:
+            retry_in = retry_in or 1.0
+            logger.warning(
+                "User change stream unavailable, connected devices will rely on periodic re-checks",
+                extra={"retry_in_seconds": retry_in, "error": str(e)}
+            )
+        await asyncio.sleep(retry_in)
+        retry_in = min(retry_in * 2, _WATCH_MAX_RETRY_SECONDS)
@@ -0,0 +1,37 @@
+# services/flusher.py
+
+import asyncio
+
+
+class PeriodicFlusher:
+    """
+    Base for write-behind buffers: a background task calls flush() every
+    `flush_interval` seconds, and stop() writes out whatever is left. Subclasses
+    implement flush() and hold `_flush_lock` while they write.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stops the background flusher and writes out whatever is still buffered."""
+        if self._flush_task is not None:
+            # Cancelled under the lock, so a flush already writing to Mongo finishes first.
+            async with self._flush_lock:
+                self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
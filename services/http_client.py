@@ -0,0 +1,92 @@
+# services/http_client.py
+
+import asyncio
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+
+import httpx
+
+from core.config import (
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_READ_TIMEOUT_SECONDS,
+    HTTP_POOL_TIMEOUT_SECONDS,
+    WARMUP_MAX_UPSTREAMS,
+    WARMUP_TIMEOUT_SECONDS,
+)
+from core.log import get_logger
+
+logger = get_logger("http_client")
+
+# One long-lived, keep-alive client per upstream origin (scheme://host:port).
+# Users pointing at the same provider share a single connection pool.
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _origin(base_url: str) -> str:
+    parts = urlsplit(base_url)
+    if not parts.scheme or not parts.netloc:
+        raise ValueError(f"Invalid upstream base_url: {base_url!r}")
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def _build_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(
+            connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+            read=HTTP_READ_TIMEOUT_SECONDS,
+            write=HTTP_CONNECT_TIMEOUT_SECONDS,
+            pool=HTTP_POOL_TIMEOUT_SECONDS,
+        ),
+    )
+
+
+def get_http_client(base_url: str) -> httpx.AsyncClient:
+    """Returns the shared pooled client for the upstream serving `base_url`."""
+    origin = _origin(base_url)
+    client = _clients.get(origin)
+    if client is None or client.is_closed:
+        client = _build_client()
+        _clients[origin] = client
+    return client
+
+
+def client_origins() -> List[str]:
+    """Upstream origins with an open pooled client."""
+    return [origin for origin, client in _clients.items() if not client.is_closed]
+
+
+async def _open_connection(origin: str):
+    try:
+        # Any response will do: the point is a pooled, already handshaken keep-alive connection.
+        await get_http_client(origin).head(origin, timeout=WARMUP_TIMEOUT_SECONDS)
+    except (httpx.HTTPError, ValueError) as e:
+        logger.info("Could not pre-connect to upstream", extra={"origin": origin, "error": str(e)})
+
+
+async def warm_up_http_clients(base_urls: Iterable[str]):
+    """Opens one connection to each distinct upstream host before traffic arrives."""
+    origins = []
+    for base_url in base_urls:
+        try:
+            origin = _origin(base_url)
+        except ValueError:
+            continue
+        if origin not in origins:
+            origins.append(origin)
+    await asyncio.gather(*(_open_connection(origin) for origin in origins[:WARMUP_MAX_UPSTREAMS]))
+
+
+async def close_http_clients():
+    """Closes every pooled upstream client. Called from the app lifespan on shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,149 @@
+# services/image_processing.py
+
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from PIL import Image, ImageChops, ImageOps
+
+from core.config import (
+    IMAGE_PREPROCESS_ENABLED,
+    IMAGE_PREPROCESS_WORKERS,
+    IMAGE_MAX_DIMENSION,
+    IMAGE_OUTPUT_FORMAT,
+    IMAGE_OUTPUT_QUALITY,
+    IMAGE_TRIM_TOLERANCE,
+)
+from core.log import get_logger
+from core.metrics import ANALYZE_STAGE_DURATION, IMAGE_BYTES, IMAGE_BYTES_SAVED
+
+logger = get_logger("image_processing")
+
+# Sent when the format cannot be recognised, which is what the pipeline always claimed before.
+DEFAULT_MIME_TYPE = "image/png"
+
+_MIME_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def detect_mime_type(image_bytes: bytes) -> Optional[str]:
+    """Identifies the image format from its magic bytes."""
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes.startswith(b"BM"):
+        return "image/bmp"
+    return None
+
+
+def _trim_borders(image: Image.Image, tolerance: int) -> Image.Image:
+    """Crops away margins that match the top-left pixel, e.g. letterboxing or empty window chrome."""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    difference = ImageChops.difference(image, background)
+    # Subtracting the tolerance zeroes out near-background noise such as compression artefacts.
+    bbox = ImageChops.add(difference, difference, 2.0, -tolerance).getbbox()
+    if bbox and bbox != (0, 0) + image.size:
+        return image.crop(bbox)
+    return image
+
+
+def _normalize(image_bytes: bytes, max_dimension: int, output_format: str, quality: int, tolerance: int) -> Tuple[bytes, str]:
+    """Runs in a pool process: decode, trim, downscale and re-encode one screenshot."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        # Flatten transparency onto white, which is what a screenshot viewer would show.
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+
+    original_size = image.size
+    image = _trim_borders(image, tolerance)
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    changed = image.size != original_size
+
+    output = io.BytesIO()
+    if output_format == "png":
+        image.save(output, "PNG", optimize=True)
+    elif output_format == "jpeg":
+        image.save(output, "JPEG", quality=quality, optimize=True)
+    else:
+        image.save(output, "WEBP", quality=quality, method=4)
+    encoded = output.getvalue()
+
+    # A small, already compact upload is worth keeping as is.
+    if not changed and len(encoded) >= len(image_bytes):
+        return image_bytes, detect_mime_type(image_bytes) or DEFAULT_MIME_TYPE
+    return encoded, _MIME_TYPES[output_format]
+
+
+def _warm_up():
+    Image.init()
+
+
+def start_image_pool():
+    """Starts the preprocessing processes. Called from the app lifespan."""
+    global _executor
+    if not IMAGE_PREPROCESS_ENABLED or _executor is not None:
+        return
+    if IMAGE_OUTPUT_FORMAT not in _MIME_TYPES:
+        logger.warning("Unknown IMAGE_OUTPUT_FORMAT, image preprocessing disabled", extra={"format": IMAGE_OUTPUT_FORMAT})
+        return
+    # Spawned rather than forked: the parent runs an event loop and Motor's threads.
+    _executor = ProcessPoolExecutor(
+        max_workers=IMAGE_PREPROCESS_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_warm_up,
+    )
+
+
+async def warm_up_image_pool():
+    """Spawns every pool process now, so the first screenshots do not pay for interpreter start-up."""
+    if _executor is None:
+        return
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(_executor, _warm_up) for _ in range(IMAGE_PREPROCESS_WORKERS)))
+
+
+def image_pool_size() -> int:
+    return IMAGE_PREPROCESS_WORKERS if _executor is not None else 0
+
+
+def shutdown_image_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def prepare_image(image_bytes: bytes) -> Tuple[bytes, str]:
+    """
+    Returns the bytes to send upstream and their MIME type. Images the pool cannot
+    decode, or any image while preprocessing is off, go out unchanged.
+    """
+    if _executor is None:
+        return image_bytes, detect_mime_type(image_bytes) or DEFAULT_MIME_TYPE
+
+    loop = asyncio.get_running_loop()
+    try:
+        with ANALYZE_STAGE_DURATION.time(stage="image_preprocess"):
+            prepared, mime_type = await loop.run_in_executor(
+                _executor, _normalize, image_bytes,
+                IMAGE_MAX_DIMENSION, IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY, IMAGE_TRIM_TOLERANCE,
+            )
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending the original", extra={"error": str(e), "bytes": len(image_bytes)})
+        return image_bytes, detect_mime_type(image_bytes) or DEFAULT_MIME_TYPE
+
+    IMAGE_BYTES.inc(len(image_bytes), direction="in")
+    IMAGE_BYTES.inc(len(prepared), direction="out")
+    IMAGE_BYTES_SAVED.observe(max(len(image_bytes) - len(prepared), 0))
+    return prepared, mime_type
@@ -1,16 +1,158 @@
 # services/llm_service.py (FINAL VERSION WITH BUCKMINSTER'S BRAIN)
 
-import requests
-from models.user import LLMConfig
+import asyncio
+import base64
+import json
+from contextlib import contextmanager
+from time import perf_counter
+from typing import AsyncIterator, Optional
+
+import httpx
+from core.log import get_logger
+from core.metrics import UPSTREAM_REQUESTS, UPSTREAM_DURATION, UPSTREAM_IN_FLIGHT, UPSTREAM_EXTRA_ATTEMPTS
+from models.user import LLMConfig, LLMEndpoint
+from services.analytics import usage_analytics
+from services.http_client import get_http_client
+from services.resilience import UpstreamUnavailableError, attempt_deadline, call_upstream, get_breaker, is_retryable, select_endpoints
+
+logger = get_logger("llm_service")
+
+# Stands in for the base64 image while the rest of the payload is serialized, so
+# the image itself never goes through json.dumps or a str round trip.
+_IMAGE_PLACEHOLDER = "__BKM_IMAGE_BASE64__"
+
+
+def _encode_payload(payload: dict, image_bytes: Optional[bytes] = None) -> bytes:
+    body = json.dumps(payload).encode()
+    if image_bytes is None:
+        return body
+    # Base64 output is plain ASCII and never needs JSON escaping.
+    before, after = body.split(_IMAGE_PLACEHOLDER.encode(), 1)
+    return b"".join((before, base64.b64encode(image_bytes), after))
+
+
+def _headers(config: LLMEndpoint) -> dict:
+    return {"Authorization": f"Bearer {config.api_key}", "Content-Type": "application/json"}
+
+
+def _record_usage(usage: Optional[dict], data: dict):
+    """Adds the token counts reported by the provider to a caller-supplied accumulator."""
+    if usage is None:
+        return
+    reported = data.get("usage") or {}
+    for field in ("prompt_tokens", "completion_tokens"):
+        usage[field] = usage.get(field, 0) + (reported.get(field) or 0)
+
+
+@contextmanager
+def _track_upstream(stage: str, config: LLMEndpoint):
+    """Records outcome, latency and in-flight metrics, and the usage rollups, for one provider request."""
+    labels = {"stage": stage, "base_url": config.base_url, "model_id": config.model_id}
+    outcome = {"status": "error"}
+    started = perf_counter()
+    UPSTREAM_IN_FLIGHT.inc(stage=stage)
+    try:
+        yield outcome
+    except httpx.TransportError as e:
+        outcome["status"] = type(e).__name__
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        # A hedge that lost its race, or a stream whose client went away; not a provider error.
+        outcome["status"] = "cancelled"
+        raise
+    finally:
+        elapsed = perf_counter() - started
+        UPSTREAM_IN_FLIGHT.dec(stage=stage)
+        UPSTREAM_REQUESTS.inc(status=outcome["status"], **labels)
+        UPSTREAM_DURATION.observe(elapsed, **labels)
+        usage_analytics.record_upstream(stage, config.model_id, outcome["status"], elapsed)
+
+
+async def _post_chat_completion(config: LLMConfig, payload: dict, stage: str, image_bytes: Optional[bytes] = None, usage: Optional[dict] = None) -> dict:
+    """
+    Sends a chat completion request over the pooled, non-blocking client for the
+    upstream, with retries, fallback endpoints and hedging handled by call_upstream.
+    """
+    bodies = {}
+
+    async def send(endpoint: LLMEndpoint, timeout: float) -> dict:
+        # Fallbacks may serve a different model, so the body is encoded once per model.
+        body = bodies.get(endpoint.model_id)
+        if body is None:
+            body = bodies[endpoint.model_id] = _encode_payload({**payload, "model": endpoint.model_id}, image_bytes)
+        client = get_http_client(endpoint.base_url)
+        with _track_upstream(stage, endpoint) as outcome:
+            async with attempt_deadline(timeout):
+                response = await client.post(endpoint.base_url, headers=_headers(endpoint), content=body)
+            outcome["status"] = str(response.status_code)
+            response.raise_for_status()
+            return response.json()
+
+    data = await call_upstream(config, stage, send)
+    _record_usage(usage, data)
+    return data
+
+
+async def _stream_from(endpoint: LLMEndpoint, payload: dict, stage: str, image_bytes: Optional[bytes]) -> AsyncIterator[str]:
+    client = get_http_client(endpoint.base_url)
+    payload = {**payload, "model": endpoint.model_id, "stream": True}
+    with _track_upstream(stage, endpoint) as outcome:
+        async with client.stream("POST", endpoint.base_url, headers=_headers(endpoint), content=_encode_payload(payload, image_bytes)) as response:
+            outcome["status"] = str(response.status_code)
+            response.raise_for_status()
+            # OpenAI-compatible SSE: one "data: {...}" line per chunk, ending with "data: [DONE]".
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                text = (choices[0].get("delta") or {}).get("content") if choices else None
+                if text:
+                    yield text
+
+
+async def _stream_chat_completion(config: LLMConfig, payload: dict, stage: str, image_bytes: Optional[bytes] = None) -> AsyncIterator[str]:
+    """
+    Sends a streaming chat completion request and yields the content deltas.
+    Moves on to the next endpoint only while nothing has been yielded yet;
+    a stream that fails halfway is not replayed.
+    """
+    error: Optional[Exception] = None
+    for index, endpoint in enumerate(select_endpoints(config)):
+        breaker = get_breaker(endpoint)
+        if not breaker.allow():
+            continue
+        if index:
+            UPSTREAM_EXTRA_ATTEMPTS.inc(stage=stage, kind="fallback")
+        started = perf_counter()
+        first_token_after = None
+        try:
+            async for text in _stream_from(endpoint, payload, stage, image_bytes):
+                if first_token_after is None:
+                    # Time to first token is what the client waits for, so that is what selection uses.
+                    first_token_after = perf_counter() - started
+                yield text
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            breaker.record_failure()
+            if first_token_after is not None:
+                raise
+            error = e
+            continue
+        breaker.record_success(first_token_after if first_token_after is not None else perf_counter() - started)
+        return
+    raise error or UpstreamUnavailableError(config.model_id)
+
 
 # IXL function waisa hi rahega, usmein koi change nahi hai
-async def get_image_description_from_ixl(image_base64: str, config: LLMConfig) -> str:
+async def get_image_description_from_ixl(image_bytes: bytes, config: LLMConfig, usage: Optional[dict] = None, mime_type: str = "image/png") -> str:
     """Uses a vision model (IXL) to get a text description of an image."""
     if not all([config.api_key, config.base_url, config.model_id]):
         raise ValueError("IXL (Vision) configuration is incomplete.")
 
-    headers = {"Authorization": f"Bearer {config.api_key}", "Content-Type": "application/json"}
-    
     payload = {
         "model": config.model_id,
         "messages": [{
@@ -20,57 +162,122 @@ async def get_image_description_from_ixl(image_base64: str, config: LLMConfig) -
                 "text": "Describe the content of this image in detail. Transcribe any text, questions, or data you see verbatim. Be precise and objective."
             }, {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{image_base64}"}
+                "image_url": {"url": f"data:{mime_type};base64,{_IMAGE_PLACEHOLDER}"}
             }]
         }],
         "max_tokens": 1024
     }
 
     try:
-        response = requests.post(config.base_url, headers=headers, json=payload, timeout=45)
-        response.raise_for_status()
-        data = response.json()
+        data = await _post_chat_completion(config, payload, "ixl", image_bytes, usage)
         return data['choices'][0]['message']['content'].strip()
-    except requests.exceptions.RequestException as e:
-        print(f"IXL API Error: {e}")
+    except (httpx.HTTPError, UpstreamUnavailableError) as e:
+        logger.warning("IXL API error", extra={"stage": "ixl", "model_id": config.model_id, "error": str(e)})
         raise ConnectionError(f"Failed to connect to the vision API (IXL). {e}")
     except Exception as e:
-        print(f"IXL Response Error: {e}")
+        logger.warning("IXL response error", extra={"stage": "ixl", "model_id": config.model_id, "error": str(e)})
         raise ValueError(f"Invalid response from the vision API (IXL). {e}")
 
 
+# YEH HAI BUCKMINSTER KA NAYA, POWERFUL PROMPT
+BUCKMINSTER_SYSTEM_PROMPT = (
+"You are Buckminster — a precise screen-content analytical AI." "You will receive text of what is visible on the user's screen." "" "Your output MUST be in this exact two-part style:" "1) FIRST — prepend ONE classifier tag." "2) THEN — write the final response." "" "────────────────────────────" "CLASSIFIER RULES - STRICTLY FOLLOW" "────────────────────────────" "You MUST FIRST scan the user's screen text to identify EXACTLY which multiple-choice options are present." "" "ONLY use these classifiers if their corresponding options ACTUALLY appear in the screen text:" "[OPTION:A] → When choosing option A" "[OPTION:B] → When choosing option B" "[OPTION:C] → When choosing option C" "[OPTION:D] → When choosing option D" "[OPTION:E] → When choosing option E" "" "CRITICAL: If the screen text shows options A, B, C, D → you CANNOT use [OPTION:X] or [OPTION:E] or any other option that doesn't actually appear." "" "[CODE] → Only when final output is pure code (no explanation)" "" "────────────────────────────" "OUTPUT FORMAT - EXACTLY FOLLOW" "────────────────────────────" "For [OPTION:*] responses:" "→ State which option is correct" "→ Wrap ONLY the final answer letter inside <answer> tags" "" "Example: \"[OPTION:B]The correct answer is <answer>B</answer>.\"" "" "For [CODE] responses:" "→ Return clean runnable code ONLY inside <answer> tags" "→ No explanations outside the tags" "" "────────────────────────────" "VALIDATION STEP - MUST DO" "────────────────────────────" "Before responding, verify:" "1. What options actually exist in the screen text? (A/B/C/D/etc.)" "2. Your classifier tag MUST match one of the existing options" "3. NEVER invent options that don't appear in the screen text" "" "BAD - [OPTION:X] (when X doesn't exist in screen)" "BAD - [OPTION:Multiplying by...] (using text as tag)" "GOOD - [OPTION:B] <answer>B</answer>"
+)
+
+
+def _build_txl_payload(description: str, config: LLMConfig) -> dict:
+    return {
+        "model": config.model_id,
+        "messages": [
+            {"role": "system", "content": BUCKMINSTER_SYSTEM_PROMPT},
+            {"role": "user", "content": description}
+        ],
+        "max_tokens": 512,
+        "temperature": 0.2
+    }
+
+
 # YEH HAI NAYA DIMAAG: TXL FUNCTION KO HUMNE UPDATE KIYA HAI
-async def get_final_answer_from_txl(description: str, config: LLMConfig) -> str:
+async def get_final_answer_from_txl(description: str, config: LLMConfig, usage: Optional[dict] = None) -> str:
     """Uses a language model (TXL) to generate a final answer based on a text description."""
     if not all([config.api_key, config.base_url, config.model_id]):
         raise ValueError("TXL (Language) configuration is incomplete.")
 
-    headers = {"Authorization": f"Bearer {config.api_key}", "Content-Type": "application/json"}
-    
-    # YEH HAI BUCKMINSTER KA NAYA, POWERFUL PROMPT
-    system_prompt = (
-"You are Buckminster — a precise screen-content analytical AI." "You will receive text of what is visible on the user's screen." "" "Your output MUST be in this exact two-part style:" "1) FIRST — prepend ONE classifier tag." "2) THEN — write the final response." "" "────────────────────────────" "CLASSIFIER RULES - STRICTLY FOLLOW" "────────────────────────────" "You MUST FIRST scan the user's screen text to identify EXACTLY which multiple-choice options are present." "" "ONLY use these classifiers if their corresponding options ACTUALLY appear in the screen text:" "[OPTION:A] → When choosing option A" "[OPTION:B] → When choosing option B" "[OPTION:C] → When choosing option C" "[OPTION:D] → When choosing option D" "[OPTION:E] → When choosing option E" "" "CRITICAL: If the screen text shows options A, B, C, D → you CANNOT use [OPTION:X] or [OPTION:E] or any other option that doesn't actually appear." "" "[CODE] → Only when final output is pure code (no explanation)" "" "────────────────────────────" "OUTPUT FORMAT - EXACTLY FOLLOW" "────────────────────────────" "For [OPTION:*] responses:" "→ State which option is correct" "→ Wrap ONLY the final answer letter inside <answer> tags" "" "Example: \"[OPTION:B]The correct answer is <answer>B</answer>.\"" "" "For [CODE] responses:" "→ Return clean runnable code ONLY inside <answer> tags" "→ No explanations outside the tags" "" "────────────────────────────" "VALIDATION STEP - MUST DO" "────────────────────────────" "Before responding, verify:" "1. What options actually exist in the screen text? (A/B/C/D/etc.)" "2. Your classifier tag MUST match one of the existing options" "3. NEVER invent options that don't appear in the screen text" "" "BAD - [OPTION:X] (when X doesn't exist in screen)" "BAD - [OPTION:Multiplying by...] (using text as tag)" "GOOD - [OPTION:B] <answer>B</answer>"
-    )
+    payload = _build_txl_payload(description, config)
 
-    
-    payload = {
+    try:
+        data = await _post_chat_completion(config, payload, "txl", usage=usage)
+        return data['choices'][0]['message']['content'].strip()
+    except (httpx.HTTPError, UpstreamUnavailableError) as e:
+        logger.warning("TXL API error", extra={"stage": "txl", "model_id": config.model_id, "error": str(e)})
+        raise ConnectionError(f"Failed to connect to the language API (TXL). {e}")
+    except Exception as e:
+        logger.warning("TXL response error", extra={"stage": "txl", "model_id": config.model_id, "error": str(e)})
+        raise ValueError(f"Invalid response from the language API (TXL). {e}")
+
+
+async def stream_final_answer_from_txl(description: str, config: LLMConfig) -> AsyncIterator[str]:
+    """Same as get_final_answer_from_txl, but yields the answer text as the model streams it."""
+    if not all([config.api_key, config.base_url, config.model_id]):
+        raise ValueError("TXL (Language) configuration is incomplete.")
+
+    try:
+        async for text in _stream_chat_completion(config, _build_txl_payload(description, config), "txl"):
+            yield text
+    except (httpx.HTTPError, UpstreamUnavailableError) as e:
+        logger.warning("TXL stream API error", extra={"stage": "txl", "model_id": config.model_id, "error": str(e)})
+        raise ConnectionError(f"Failed to connect to the language API (TXL). {e}")
+    except (ValueError, KeyError, IndexError, AttributeError) as e:
+        logger.warning("TXL stream response error", extra={"stage": "txl", "model_id": config.model_id, "error": str(e)})
+        raise ValueError(f"Invalid response from the language API (TXL). {e}")
+
+
+def _build_fused_payload(config: LLMConfig, mime_type: str) -> dict:
+    return {
         "model": config.model_id,
         "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": description}
+            {"role": "system", "content": BUCKMINSTER_SYSTEM_PROMPT},
+            {"role": "user", "content": [{
+                "type": "text",
+                "text": "This is a screenshot of the user's screen. Read everything visible on it, then answer."
+            }, {
+                "type": "image_url",
+                "image_url": {"url": f"data:{mime_type};base64,{_IMAGE_PLACEHOLDER}"}
+            }]}
         ],
         "max_tokens": 512,
         "temperature": 0.2
     }
 
+
+# Fused mode: ek hi multimodal call, IXL -> TXL ka double hop nahi
+async def get_final_answer_from_image(image_bytes: bytes, config: LLMConfig, usage: Optional[dict] = None, mime_type: str = "image/png") -> str:
+    """Sends the screenshot straight to a multimodal TXL model together with the Buckminster prompt."""
+    if not all([config.api_key, config.base_url, config.model_id]):
+        raise ValueError("TXL (Language) configuration is incomplete.")
+
     try:
-        response = requests.post(config.base_url, headers=headers, json=payload, timeout=45)
-        response.raise_for_status()
-        data = response.json()
+        data = await _post_chat_completion(config, _build_fused_payload(config, mime_type), "fused", image_bytes, usage)
         return data['choices'][0]['message']['content'].strip()
-    except requests.exceptions.RequestException as e:
-        print(f"TXL API Error: {e}")
+    except (httpx.HTTPError, UpstreamUnavailableError) as e:
+        logger.warning("Fused TXL API error", extra={"stage": "fused", "model_id": config.model_id, "error": str(e)})
         raise ConnectionError(f"Failed to connect to the language API (TXL). {e}")
     except Exception as e:
-        print(f"TXL Response Error: {e}")
-        raise ValueError(f"Invalid response from the language API (TXL). {e}")
\ No newline at end of file
+        logger.warning("Fused TXL response error", extra={"stage": "fused", "model_id": config.model_id, "error": str(e)})
+        raise ValueError(f"Invalid response from the language API (TXL). {e}")
+
+
+async def stream_final_answer_from_image(image_bytes: bytes, config: LLMConfig, mime_type: str = "image/png") -> AsyncIterator[str]:
+    """Streaming variant of get_final_answer_from_image."""
+    if not all([config.api_key, config.base_url, config.model_id]):
+        raise ValueError("TXL (Language) configuration is incomplete.")
+
+    try:
+        async for text in _stream_chat_completion(config, _build_fused_payload(config, mime_type), "fused", image_bytes):
+            yield text
+    except (httpx.HTTPError, UpstreamUnavailableError) as e:
+        logger.warning("Fused TXL stream API error", extra={"stage": "fused", "model_id": config.model_id, "error": str(e)})
+        raise ConnectionError(f"Failed to connect to the language API (TXL). {e}")
+    except (ValueError, KeyError, IndexError, AttributeError) as e:
+        logger.warning("Fused TXL stream response error", extra={"stage": "fused", "model_id": config.model_id, "error": str(e)})
+        raise ValueError(f"Invalid response from the language API (TXL). {e}")
@@ -0,0 +1,239 @@
+# services/resilience.py
+
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import httpx
+
+from core.config import (
+    UPSTREAM_MAX_ATTEMPTS,
+    UPSTREAM_RETRY_BASE_DELAY_SECONDS,
+    UPSTREAM_RETRY_MAX_DELAY_SECONDS,
+    UPSTREAM_CALL_BUDGET_SECONDS,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_SECONDS,
+    UPSTREAM_HEDGE_AFTER_SECONDS,
+    UPSTREAM_SLOW_FACTOR,
+)
+from core.log import get_logger
+from core.metrics import UPSTREAM_EXTRA_ATTEMPTS, UPSTREAM_CIRCUIT_OPEN
+from models.user import LLMConfig, LLMEndpoint
+
+logger = get_logger("resilience")
+
+T = TypeVar("T")
+
+# Weight of the newest sample in an endpoint's moving latency average.
+_LATENCY_ALPHA = 0.2
+
+
+class UpstreamUnavailableError(ConnectionError):
+    """Raised without contacting the provider when every endpoint's circuit is open."""
+
+    def __init__(self, model_id: Optional[str]):
+        super().__init__(f"All upstream endpoints for {model_id} are failing; not retrying until their circuits reset.")
+
+
+class CircuitBreaker:
+    """
+    Health of one provider endpoint. Opens after CIRCUIT_FAILURE_THRESHOLD
+    consecutive failures; once CIRCUIT_RESET_SECONDS have passed, one request
+    is let through as a probe, and its outcome closes the circuit or keeps it
+    open for another interval. Also keeps a moving average of successful latency.
+    """
+
+    def __init__(self, base_url: str, model_id: str):
+        self.base_url = base_url
+        self.model_id = model_id
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.latency: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def available(self) -> bool:
+        """True if a request may be sent now, without claiming the probe slot."""
+        return self.opened_at is None or monotonic() - self.opened_at >= CIRCUIT_RESET_SECONDS
+
+    def allow(self) -> bool:
+        """Like available(), but claims the probe slot of an open circuit."""
+        if self.opened_at is None:
+            return True
+        if monotonic() - self.opened_at >= CIRCUIT_RESET_SECONDS:
+            # Restart the interval so concurrent requests do not all probe at once.
+            self.opened_at = monotonic()
+            return True
+        return False
+
+    def record_success(self, seconds: float):
+        if self.opened_at is not None:
+            logger.info("Upstream circuit closed", extra={"base_url": self.base_url, "model_id": self.model_id})
+            UPSTREAM_CIRCUIT_OPEN.set(0, base_url=self.base_url, model_id=self.model_id)
+        self.failures = 0
+        self.opened_at = None
+        self.latency = seconds if self.latency is None else _LATENCY_ALPHA * seconds + (1 - _LATENCY_ALPHA) * self.latency
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None:
+            self.opened_at = monotonic()
+        elif self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.opened_at = monotonic()
+            logger.warning("Upstream circuit opened", extra={"base_url": self.base_url, "model_id": self.model_id, "failures": self.failures})
+            UPSTREAM_CIRCUIT_OPEN.set(1, base_url=self.base_url, model_id=self.model_id)
+
+    def snapshot(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "model_id": self.model_id,
+            "open": self.is_open,
+            "consecutive_failures": self.failures,
+            "avg_latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+        }
+
+
+# One breaker per (base_url, model_id), shared by every user configured with that endpoint.
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+
+def get_breaker(endpoint: LLMEndpoint) -> CircuitBreaker:
+    key = (endpoint.base_url, endpoint.model_id)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = CircuitBreaker(endpoint.base_url, endpoint.model_id)
+    return breaker
+
+
+def upstream_health() -> List[dict]:
+    return [breaker.snapshot() for breaker in _breakers.values()]
+
+
+def select_endpoints(config: LLMConfig) -> List[LLMEndpoint]:
+    """
+    Endpoints worth trying, best first: configured order, minus endpoints whose
+    circuit is open, with slow endpoints moved behind the rest.
+    """
+    candidates = [endpoint for endpoint in config.endpoints() if get_breaker(endpoint).available()]
+    if not candidates:
+        raise UpstreamUnavailableError(config.model_id)
+    latencies = [get_breaker(endpoint).latency for endpoint in candidates]
+    known = [latency for latency in latencies if latency is not None]
+    if len(known) < 2:
+        return candidates
+    threshold = min(known) * UPSTREAM_SLOW_FACTOR
+    # Endpoints without samples yet count as fast so they get measured.
+    return [endpoint for endpoint, latency in sorted(zip(candidates, latencies), key=lambda pair: pair[1] is not None and pair[1] > threshold)]
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Network errors, rate limiting and server errors are worth another attempt; other 4xx are not."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _backoff(retry: int) -> float:
+    # Full jitter keeps retries from many workers from arriving in lockstep.
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY_SECONDS, UPSTREAM_RETRY_BASE_DELAY_SECONDS * 2 ** retry))
+
+
+@asynccontextmanager
+async def attempt_deadline(seconds: float):
+    """Bounds one provider request by the time left in its call; running out counts as a timeout."""
+    try:
+        async with asyncio.timeout(seconds):
+            yield
+    except TimeoutError:
+        raise httpx.ReadTimeout(f"Upstream call took longer than its {UPSTREAM_CALL_BUDGET_SECONDS:g}s budget")
+
+
+async def _attempt(endpoint: LLMEndpoint, send: Callable[[LLMEndpoint, float], Awaitable[T]], deadline: float) -> T:
+    breaker = get_breaker(endpoint)
+    started = monotonic()
+    try:
+        result = await send(endpoint, deadline - started)
+    except Exception as e:
+        # Cancelled hedges never get here, so losing a race is not counted as a failure.
+        if is_retryable(e):
+            breaker.record_failure()
+        raise
+    breaker.record_success(monotonic() - started)
+    return result
+
+
+async def _hedged_attempt(primary: LLMEndpoint, secondary: LLMEndpoint, send, hedge_after: float, stage: str, launched: List[LLMEndpoint], deadline: float):
+    """
+    Starts a second request if the first is slow; the first success wins and the other
+    is cancelled. Each endpoint is appended to `launched` when its request starts.
+    """
+    launched.append(primary)
+    pending = {asyncio.create_task(_attempt(primary, send, deadline))}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        # No hedge once the call's budget is spent; the primary is about to time out as well.
+        if not done and monotonic() < deadline and get_breaker(secondary).allow():
+            UPSTREAM_EXTRA_ATTEMPTS.inc(stage=stage, kind="hedge")
+            launched.append(secondary)
+            pending.add(asyncio.create_task(_attempt(secondary, send, deadline)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_upstream(config: LLMConfig, stage: str, send: Callable[[LLMEndpoint, float], Awaitable[T]]) -> T:
+    """
+    Runs `send` against the configured endpoints with circuit breaking, bounded
+    retries, fallbacks and optional hedging. Endpoints are tried in selection
+    order; once all have been tried, the rotation starts again after a backoff.
+    The whole call gets UPSTREAM_CALL_BUDGET_SECONDS: `send` is passed the seconds
+    left for its request, and no retry or hedge starts once they have run out.
+    """
+    endpoints = select_endpoints(config)
+    hedge_after = config.hedge_after_seconds if config.hedge_after_seconds is not None else UPSTREAM_HEDGE_AFTER_SECONDS
+    deadline = monotonic() + UPSTREAM_CALL_BUDGET_SECONDS
+    error: Optional[Exception] = None
+    attempt = 0
+    while attempt < UPSTREAM_MAX_ATTEMPTS and monotonic() < deadline:
+        endpoint = endpoints[attempt % len(endpoints)]
+        if not get_breaker(endpoint).allow():
+            attempt += 1
+            continue
+        if attempt >= len(endpoints):
+            delay = _backoff(attempt // len(endpoints) - 1)
+            if monotonic() + delay >= deadline:
+                break
+            UPSTREAM_EXTRA_ATTEMPTS.inc(stage=stage, kind="retry")
+            await asyncio.sleep(delay)
+        elif attempt:
+            UPSTREAM_EXTRA_ATTEMPTS.inc(stage=stage, kind="fallback")
+        try:
+            if hedge_after > 0 and attempt + 1 < UPSTREAM_MAX_ATTEMPTS:
+                secondary = endpoints[(attempt + 1) % len(endpoints)]
+                launched: List[LLMEndpoint] = []
+                try:
+                    return await _hedged_attempt(endpoint, secondary, send, hedge_after, stage, launched, deadline)
+                finally:
+                    # Only requests that were actually sent use up the budget; without a
+                    # hedge, the secondary is simply the next endpoint in the rotation.
+                    attempt += len(launched)
+            attempt += 1
+            return await _attempt(endpoint, send, deadline)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            error = e
+            logger.info("Upstream attempt failed", extra={"stage": stage, "base_url": endpoint.base_url, "model_id": endpoint.model_id, "error": str(e)})
+    raise error or UpstreamUnavailableError(config.model_id)
@@ -0,0 +1,74 @@
+# services/result_cache.py
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import PyMongoError
+
+from core.cache import TTLCache
+from core.config import RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MONGO_ENABLED
+from core.database import analysis_cache_collection
+from core.log import get_logger
+from models.user import LLMConfig
+
+logger = get_logger("result_cache")
+
+# Keyed by a hash of the decoded image plus the endpoints that analyzed it.
+# Values are {"description": ..., "answer": ...}; fused runs have no description.
+_memory_cache = TTLCache(maxsize=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL_SECONDS)
+
+
+def _endpoints_identity(config: LLMConfig) -> list:
+    return [[endpoint.base_url, endpoint.model_id, endpoint.api_key] for endpoint in config.endpoints()]
+
+
+def result_cache_key(image_bytes: bytes, ixl_config: LLMConfig, txl_config: LLMConfig, pipeline_mode: str = "two_stage") -> str:
+    """
+    Content address for an analysis, also used to coalesce concurrent duplicates.
+    Covers every endpoint a call may use, fallbacks and API keys included, so an
+    answer is only shared between users whose own credentials would have produced it.
+    Only the digest is stored, never the keys.
+    """
+    digest = hashlib.sha256(image_bytes)
+    endpoints = [pipeline_mode, _endpoints_identity(txl_config)]
+    if pipeline_mode != "fused":
+        endpoints.append(_endpoints_identity(ixl_config))
+    digest.update(json.dumps(endpoints).encode())
+    return digest.hexdigest()
+
+
+async def get_cached_result(key: str) -> Optional[dict]:
+    result = _memory_cache.get(key)
+    if result is not None or not RESULT_CACHE_MONGO_ENABLED:
+        return result
+    try:
+        # Mongo's TTL monitor only runs once a minute, so check the age here as well.
+        doc = await analysis_cache_collection.find_one({
+            "_id": key,
+            "created_at": {"$gt": datetime.utcnow() - timedelta(seconds=RESULT_CACHE_TTL_SECONDS)},
+        })
+    except PyMongoError as e:
+        logger.warning("Result cache lookup failed", extra={"error": str(e)})
+        return None
+    if doc is None:
+        return None
+    result = {"description": doc["description"], "answer": doc["answer"]}
+    _memory_cache.set(key, result)
+    return result
+
+
+async def store_result(key: str, description: Optional[str], answer: str):
+    result = {"description": description, "answer": answer}
+    _memory_cache.set(key, result)
+    if not RESULT_CACHE_MONGO_ENABLED:
+        return
+    try:
+        await analysis_cache_collection.replace_one(
+            {"_id": key},
+            {**result, "created_at": datetime.utcnow()},
+            upsert=True,
+        )
+    except PyMongoError as e:
+        logger.warning("Result cache store failed", extra={"error": str(e)})
@@ -0,0 +1,121 @@
+# services/usage.py
+
+from collections import defaultdict
+from typing import Dict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from core.cache import TTLCache
+from core.config import USAGE_FLUSH_INTERVAL_SECONDS, USER_CACHE_MAX_ENTRIES
+from core.database import user_collection
+from core.log import get_logger
+from core.metrics import BACKGROUND_FLUSH_DURATION
+from core.user_cache import evict_users
+from services.flusher import PeriodicFlusher
+
+logger = get_logger("usage")
+
+# A user's floor is dropped after this long without calls; no request holds a user document that long.
+_FLOOR_IDLE_SECONDS = 600
+
+
+class UsageTracker(PeriodicFlusher):
+    """
+    Per-worker quota reservations plus write-behind `api_calls_total` counters.
+
+    A call reserves quota before the upstream work starts, then either commits the
+    reservation (success) or refunds it (failure). Committed calls are buffered and
+    written to Mongo with one `bulk_write` per flush interval.
+
+    The user document a request checks against may have been read before this
+    worker's latest flush (it can sit in the user cache, or a request may await an
+    admission slot or a body upload after the lookup). The tracker therefore keeps,
+    per user, the lowest total Mongo can hold after its own flushes and checks
+    against whichever is higher. Together with reserving without an await after the
+    check, a worker cannot overshoot a limit on its own. Across workers the
+    overshoot is bounded by the other workers' calls that this worker has not seen
+    yet: their unflushed buffers plus whatever they flushed within
+    USER_CACHE_TTL_SECONDS of this worker's copy of the user being read.
+    """
+
+    def __init__(self, flush_interval: float):
+        super().__init__(flush_interval)
+        self._reserved: Dict[str, int] = defaultdict(int)
+        self._pending: Dict[str, int] = defaultdict(int)
+        # Lower bound of each user's api_calls_total in Mongo. Kept while the user is
+        # active, long enough to outlive any document a request read before a flush.
+        self._floors = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=_FLOOR_IDLE_SECONDS)
+
+    def _outstanding(self, user_id) -> int:
+        return self._reserved.get(user_id, 0) + self._pending.get(user_id, 0)
+
+    def _known_total(self, user: dict) -> int:
+        """The user's api_calls_total, raised to what this worker's flushes have made it."""
+        total = max(user.get("api_calls_total", 0), self._floors.get(user["_id"], 0))
+        self._floors.set(user["_id"], total)
+        return total
+
+    def reserve(self, user: dict, count: int = 1) -> bool:
+        """Reserves `count` calls against the user's limit. Returns False if it would be exceeded."""
+        limit = user.get("api_call_limit")
+        user_id = user["_id"]
+        if limit is not None and self._known_total(user) + self._outstanding(user_id) + count > limit:
+            return False
+        self._reserved[user_id] += count
+        return True
+
+    def _release(self, user_id, count: int):
+        self._reserved[user_id] -= count
+        if self._reserved[user_id] <= 0:
+            del self._reserved[user_id]
+
+    def commit(self, user: dict, count: int = 1):
+        """Turns a reservation into a buffered increment."""
+        if count <= 0:
+            return
+        self._release(user["_id"], count)
+        self._pending[user["_id"]] += count
+
+    def refund(self, user: dict, count: int = 1):
+        """Gives back a reservation whose call failed upstream."""
+        if count <= 0:
+            return
+        self._release(user["_id"], count)
+
+    async def flush(self):
+        """Writes all buffered increments to Mongo in one unordered bulk write."""
+        async with self._flush_lock:
+            batch = dict(self._pending)
+            if not batch:
+                return
+            user_ids = list(batch)
+            floors = {user_id: self._floors.get(user_id, 0) for user_id in user_ids}
+            failed = set()
+            try:
+                with BACKGROUND_FLUSH_DURATION.time(buffer="usage_counters"):
+                    await user_collection.bulk_write(
+                        [UpdateOne({"_id": user_id}, {"$inc": {"api_calls_total": batch[user_id]}}) for user_id in user_ids],
+                        ordered=False,
+                    )
+            except BulkWriteError as e:
+                failed = {user_ids[error["index"]] for error in e.details.get("writeErrors", [])}
+                logger.error("Usage flush partially failed", extra={"failed_users": len(failed), "error": str(e)})
+            except PyMongoError as e:
+                logger.error("Usage flush failed, will retry", extra={"error": str(e)})
+                return
+
+            # Counts stay in _pending until they are in Mongo, so a user loaded
+            # mid-flush is over-counted for a moment rather than under-counted.
+            flushed = [user_id for user_id in user_ids if user_id not in failed]
+            for user_id in flushed:
+                self._pending[user_id] -= batch[user_id]
+                if self._pending[user_id] <= 0:
+                    del self._pending[user_id]
+                # From the floor as it was before the write, so a document read during it is not counted twice.
+                self._floors.set(user_id, max(self._floors.get(user_id, 0), floors[user_id] + batch[user_id]))
+            # Cached documents now hold stale totals; reload them on next use.
+            evict_users(flushed)
+
+
+usage_tracker = UsageTracker(flush_interval=USAGE_FLUSH_INTERVAL_SECONDS)
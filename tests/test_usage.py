@@ -0,0 +1,107 @@
+# tests/test_usage.py
+
+import unittest
+from unittest import mock
+
+from bench import fake_mongo
+
+fake_mongo.install()
+
+from core.database import user_collection  # noqa: E402
+from services.usage import UsageTracker  # noqa: E402
+
+
+class UsageTrackerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await user_collection.delete_many({})
+        self.tracker = UsageTracker(flush_interval=3600)
+
+    async def _user(self, total: int, limit: int) -> dict:
+        await user_collection.insert_one({"_id": "u1", "api_calls_total": total, "api_call_limit": limit})
+        return await user_collection.find_one({"_id": "u1"})
+
+    async def _stored_total(self) -> int:
+        return (await user_collection.find_one({"_id": "u1"}))["api_calls_total"]
+
+    async def test_reserve_respects_limit(self):
+        user = await self._user(total=3, limit=5)
+        self.assertTrue(self.tracker.reserve(user))
+        self.assertTrue(self.tracker.reserve(user))
+        self.assertFalse(self.tracker.reserve(user))
+
+    async def test_reserve_counts_pending_calls(self):
+        user = await self._user(total=3, limit=5)
+        self.assertTrue(self.tracker.reserve(user, 2))
+        self.tracker.commit(user, 2)
+        self.assertFalse(self.tracker.reserve(user))
+
+    async def test_refund_gives_the_reservation_back(self):
+        user = await self._user(total=4, limit=5)
+        self.assertTrue(self.tracker.reserve(user))
+        self.tracker.refund(user)
+        self.assertTrue(self.tracker.reserve(user))
+
+    async def test_batch_reserve_is_all_or_nothing(self):
+        user = await self._user(total=2, limit=5)
+        self.assertFalse(self.tracker.reserve(user, 4))
+        self.assertTrue(self.tracker.reserve(user, 3))
+
+    async def test_flush_writes_committed_calls(self):
+        user = await self._user(total=1, limit=10)
+        self.tracker.reserve(user, 3)
+        self.tracker.commit(user, 2)
+        self.tracker.refund(user, 1)
+        await self.tracker.flush()
+        self.assertEqual(await self._stored_total(), 3)
+        await self.tracker.flush()
+        self.assertEqual(await self._stored_total(), 3)
+
+    async def test_stale_document_after_flush_cannot_overshoot(self):
+        user = await self._user(total=4, limit=5)
+        stale = dict(user)
+        self.assertTrue(self.tracker.reserve(user))
+        self.tracker.commit(user)
+        await self.tracker.flush()
+        self.assertEqual(await self._stored_total(), 5)
+        self.assertFalse(self.tracker.reserve(stale))
+
+    async def test_fresh_document_after_flush_is_not_counted_twice(self):
+        user = await self._user(total=4, limit=6)
+        self.assertTrue(self.tracker.reserve(user))
+        self.tracker.commit(user)
+        await self.tracker.flush()
+        fresh = await user_collection.find_one({"_id": "u1"})
+        self.assertTrue(self.tracker.reserve(fresh))
+        self.assertFalse(self.tracker.reserve(fresh))
+
+    async def test_document_read_during_flush_is_not_counted_twice(self):
+        user = await self._user(total=4, limit=7)
+        self.assertTrue(self.tracker.reserve(user))
+        self.tracker.commit(user)
+        bulk_write = user_collection.bulk_write
+
+        async def bulk_write_then_read(*args, **kwargs):
+            # A request loads the user after the increment landed but before the flush finished.
+            result = await bulk_write(*args, **kwargs)
+            current = await user_collection.find_one({"_id": "u1"})
+            self.assertTrue(self.tracker.reserve(current))
+            self.tracker.refund(current)
+            return result
+
+        with mock.patch.object(user_collection, "bulk_write", bulk_write_then_read):
+            await self.tracker.flush()
+        fresh = await user_collection.find_one({"_id": "u1"})
+        self.assertTrue(self.tracker.reserve(fresh, 2))
+        self.assertFalse(self.tracker.reserve(fresh))
+
+    async def test_stop_flushes_pending_calls(self):
+        user = await self._user(total=0, limit=10)
+        self.tracker.start()
+        self.tracker.reserve(user, 2)
+        self.tracker.commit(user, 2)
+        await self.tracker.stop()
+        self.assertEqual(await self._stored_total(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()